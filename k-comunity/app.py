@@ -1,6 +1,5 @@
 import streamlit as st
 import sqlite3
-import pandas as pd
 import datetime
 import os
 import time
@@ -9,10 +8,26 @@ import io
 import altair as alt
 import random
 import math
+import re
 import plotly.express as px
 from passlib.context import CryptContext  # Para hashing de contraseñas
 import numpy as np
-import shutil
+import functools
+import itertools
+import collections
+import threading
+import hmac
+import hashlib
+import csv
+import secrets
+import queue
+import tempfile
+import pathlib
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Auditoría del Dashboard en consola (DEBUG_STATS=1); apagada por defecto
+DEBUG_STATS = os.getenv("DEBUG_STATS") == "1"
 
 # --- CONFIGURACIÓN DE PÁGINA Y SEGURIDAD ---
 st.set_page_config(
@@ -24,6 +39,8 @@ st.set_page_config(
 
 # Contexto para hashear contraseñas
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+# Pool para hashear fuera del hilo del script (argon2 es costoso a propósito)
+HASH_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pwd-hash")
 # ==========================================
 # ⚙️ CONFIGURACIÓN DE BASE DE DATOS (PRODUCCIÓN)
 # ==========================================
@@ -37,93 +54,468 @@ if not os.path.exists(DB_PATH):
 else:
     print(f"✅ MODO PRODUCCIÓN: Conectado al Disco Persistente en {DB_PATH}")
 
-def get_db_conn():
-    """Crea una conexión segura a la base de datos correcta."""
-    conn = sqlite3.connect(DB_PATH)
+# Categorías de las preguntas (crear y editar usan la misma lista)
+CATEGORIAS_MEDICAS = (
+    "Medicina Interna", "Cirugía General", "Ortopedia", "Urología",
+    "ORL", "Urgencia", "Psiquiatría", "Neurología", "Neurocirugía",
+    "Epidemiología", "Pediatría", "Ginecología", "Oftalmología", "Otra"
+)
+
+# --- SQL DEL PANEL DE ADMIN ---
+# Texto constante = misma clave en la caché de sentencias preparadas de sqlite3
+SQL_INSERT_DELETED = "INSERT INTO deleted_users_log (username, deletion_date, reason) VALUES (?, ?, ?)"
+SQL_PARDON = "UPDATE users SET status = 'active' WHERE username = ?"
+SQL_LOG_PARDONED = "INSERT INTO activity_log (username, action_type, timestamp) VALUES (?, 'pardoned', ?)"
+SQL_SET_APPROVED = "UPDATE users SET is_approved = ? WHERE username = ?"
+SQL_UPDATE_PASSWORD = "UPDATE users SET password_hash = ? WHERE username = ?"
+
+# --- SQL DE RUTAS CALIENTES (se ejecutan en cada render o interacción) ---
+SQL_LOG_INSERT = "INSERT INTO activity_log (username, action_type, timestamp, metadata) VALUES (?, ?, ?, ?)"
+SQL_USER_ROLE = "SELECT role FROM users WHERE username = ?"
+SQL_USER_VOTE = "SELECT vote_type FROM question_votes WHERE user_username = ? AND question_id = ?"
+SQL_UPSERT_VOTE = "INSERT OR REPLACE INTO question_votes (user_username, question_id, vote_type, timestamp) VALUES (?, ?, ?, ?)"
+SQL_COUNT_UNLIKES = "SELECT COUNT(*) FROM question_votes WHERE question_id = ? AND vote_type = -1"
+SQL_ADD_KARMA = "UPDATE questions SET karma = karma + ? WHERE id = ?"
+SQL_SRS_STATE = "SELECT stability, difficulty, aciertos, fallos FROM progress WHERE username = ? AND question_id = ?"
+SQL_SRS_UPSERT = """
+    INSERT INTO progress (username, question_id, due_date, interval, aciertos, fallos, stability, difficulty, last_review)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(username, question_id) DO UPDATE SET
+        due_date = excluded.due_date,
+        interval = excluded.interval,
+        aciertos = excluded.aciertos,
+        fallos = excluded.fallos,
+        stability = excluded.stability,
+        difficulty = excluded.difficulty,
+        last_review = excluded.last_review
+"""
+SQL_LOG_ANSWER = "INSERT INTO activity_log (username, action_type, timestamp) VALUES (?, 'answer', ?)"
+SQL_TOUCH_ACTIVITY = """
+    UPDATE users SET
+        current_streak = CASE
+            WHEN last_active_date = date(:today, '-1 day') THEN COALESCE(current_streak, 0) + 1
+            ELSE 1 END,
+        total_active_days = CASE
+            WHEN last_active_date IS NULL THEN 1
+            ELSE COALESCE(total_active_days, 0) + 1 END,
+        last_active_date = :today
+    WHERE username = :username
+      AND (last_active_date IS NULL OR last_active_date != :today)
+"""
+SQL_LOGIN_USER = """
+    SELECT u.*, (SELECT MAX(a.timestamp) FROM activity_log a WHERE a.username = u.username) AS last_ts
+    FROM users u
+    WHERE u.username = ?
+"""
+# Token bucket: ráfaga de hasta RATE_LIMIT_CAPACITY acciones, luego RATE_LIMIT_PER_SECOND sostenido
+RATE_LIMIT_CAPACITY = 5
+RATE_LIMIT_PER_SECOND = 0.5
+# Verificaciones de contraseña por usuario+IP: 5 intentos, recarga de 5 cada 15 minutos
+LOGIN_VERIFY_CAPACITY = 5
+LOGIN_VERIFY_PER_SECOND = 5 / 900
+# Recarga y consumo en un solo UPSERT atómico; solo devuelve fila si había al menos 1 ficha
+SQL_TAKE_TOKEN = """
+    INSERT INTO rate_buckets (key, tokens, last_refill) VALUES (:key, :cap - 1, :now)
+    ON CONFLICT(key) DO UPDATE SET
+        tokens = MIN(:cap, tokens + (:now - last_refill) * :rate) - 1,
+        last_refill = :now
+    WHERE MIN(:cap, tokens + (:now - last_refill) * :rate) >= 1
+    RETURNING tokens
+"""
+# Un bucket sin uso durante más tiempo que su recarga completa equivale a uno nuevo: se borra
+RATE_BUCKET_TTL = max(RATE_LIMIT_CAPACITY / RATE_LIMIT_PER_SECOND, LOGIN_VERIFY_CAPACITY / LOGIN_VERIFY_PER_SECOND)
+SQL_PRUNE_BUCKETS = "DELETE FROM rate_buckets WHERE last_refill < :now - :ttl"
+SQL_QUESTION_VOTES = """
+    SELECT
+        COALESCE(SUM(CASE WHEN vote_type = 1 THEN 1 ELSE 0 END), 0) as likes,
+        COALESCE(SUM(CASE WHEN vote_type = -1 THEN 1 ELSE 0 END), 0) as unlikes
+    FROM question_votes
+    WHERE question_id = ?
+"""
+
+# --- SQL DE GESTIÓN DE PREGUNTAS (mismo texto en cada llamada: reutiliza la sentencia preparada) ---
+SQL_QUESTION_BY_ID = "SELECT * FROM questions WHERE id = ?"
+SQL_QUESTION_OWNER = "SELECT owner_username FROM questions WHERE id = ?"
+SQL_UPDATE_QUESTION = "UPDATE questions SET enunciado=?, opciones=?, correcta=?, retroalimentacion=?, tag_categoria=?, tag_tema=? WHERE id=?"
+SQL_DELETE_QUESTION = "DELETE FROM questions WHERE id = ?"
+
+class OptimizingConnection(sqlite3.Connection):
+    """Conexión que ejecuta PRAGMA optimize al cerrarse (recomendación oficial de SQLite)."""
+    def close(self):
+        try:
+            # Casi siempre no hace nada; a veces corre un ANALYZE acotado si las estadísticas envejecieron
+            self.execute("PRAGMA optimize")
+        except sqlite3.Error:
+            pass
+        super().close()
+
+@st.cache_resource(show_spinner=False)
+def _init_db_file(db_path):
+    """
+    Ajustes del archivo, una sola vez por proceso: modo WAL (lectores y escritor no se
+    bloquean) y estadísticas base para el planificador (optimize sobre todas las tablas).
+    """
+    with closing(sqlite3.connect(db_path)) as conn:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA optimize = 0x10002")
+    return True
+
+def _open_db_conn():
+    """Abre una conexión nueva a la base de datos correcta."""
+    _init_db_file(DB_PATH)
+    # check_same_thread=False: Streamlit puede atender reruns de la misma sesión desde otro hilo
+    # cached_statements: más sentencias preparadas reutilizables por conexión (por defecto 128);
+    # la conexión de la sesión vive toda la sesión y recorre todas las páginas
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=512, factory=OptimizingConnection)
+    conn.row_factory = sqlite3.Row
+    # PRAGMAs por conexión (el modo WAL es persistente y lo fija _init_db_file)
+    conn.execute("PRAGMA synchronous = NORMAL")   # Seguro en WAL, sin fsync en cada commit
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA mmap_size = 268435456")  # 256 MB
+    conn.execute("PRAGMA cache_size = -65536")    # 64 MB
+    conn.execute("PRAGMA busy_timeout = 5000")    # Esperar hasta 5 s un lock en vez de fallar
+    conn.execute("PRAGMA foreign_keys = ON")      # Integridad y borrados en cascada (apagado por defecto)
+    # lower() de SQLite solo pliega ASCII; esta versión respeta tildes y eñes en las búsquedas
+    conn.create_function("unicode_lower", 1, lambda text: text.lower() if text else text, deterministic=True)
+    return conn
+
+def open_read_only_conn():
+    """Conexión nueva de solo lectura (mode=ro). En WAL varias pueden leer en paralelo con el escritor."""
+    conn = sqlite3.connect(f"{pathlib.Path(DB_PATH).resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     return conn
+
+RO_POOL_TIMEOUT = 2  # Segundos de espera por un lector del pool antes de abrir uno temporal
+
+@st.cache_resource(show_spinner=False)
+def _ro_pool(size=4):
+    """Pool de conexiones de solo lectura compartido por todo el proceso (se abren una sola vez)."""
+    pool = queue.Queue(maxsize=size)
+    for _ in range(size):
+        pool.put(open_read_only_conn())
+    return pool
+
+@contextmanager
+def db_conn(write=False):
+    """
+    Conexión para un bloque `with`: write=True entrega la conexión de la sesión
+    (única que escribe); si no, toma un lector del pool y lo devuelve al salir.
+    """
+    if write:
+        yield get_db_conn()
+        return
+    pool = _ro_pool()
+    try:
+        conn = pool.get(timeout=RO_POOL_TIMEOUT)
+    except queue.Empty:
+        # Pool agotado (lectores anidados o muchas sesiones a la vez): lector temporal propio
+        with closing(open_read_only_conn()) as conn:
+            yield conn
+        return
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+def get_db_conn():
+    """
+    Devuelve la conexión de la sesión actual. Se abre una sola vez por sesión y se
+    reutiliza en cada rerun (no se debe cerrar). Las escrituras van en `with conn:`.
+    """
+    conn = st.session_state.get('_db_conn')
+    if conn is None:
+        conn = _open_db_conn()
+        st.session_state._db_conn = conn
+    return conn
+
+def close_session_db_conn():
+    """Cierra la conexión de la sesión (al cerrar sesión); close() corre PRAGMA optimize."""
+    conn = st.session_state.pop('_db_conn', None)
+    if conn is not None:
+        conn.close()
 # ==========================================
 
+@st.cache_data(ttl=300, show_spinner=False)
 def get_ghost_profile():
     # Devuelve el diccionario del Usuario Fantasma (Referencia) o None.
-    conn = get_db_conn()
+    # Cacheado: solo cambia al guardar el formulario del Fantasma o al borrar usuarios.
     # Buscamos al usuario marcado como modelo (1)
     try:
-        row = conn.execute("SELECT * FROM users WHERE is_reference_model = 1 LIMIT 1").fetchone()
+        with db_conn() as conn:
+            row = conn.execute("SELECT * FROM users WHERE is_reference_model = 1 LIMIT 1").fetchone()
         if row:
-            # Convertimos el objeto sqlite3.Row a un diccionario normal
-            return dict(row)
+            # Convertimos el objeto sqlite3.Row a un diccionario normal (sin el hash: va a la caché)
+            ghost = dict(row)
+            ghost.pop('password_hash', None)
+            return ghost
     except Exception as e:
         print(f"Error buscando fantasma: {e}")
     return None
 
+# Esquema base (tablas e índices originales); se ejecuta como un único script
+SCHEMA_DDL = """
+CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password_hash TEXT NOT NULL, role TEXT NOT NULL DEFAULT 'user') WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS questions (id INTEGER PRIMARY KEY AUTOINCREMENT, owner_username TEXT NOT NULL REFERENCES users(username), enunciado TEXT NOT NULL, opciones TEXT NOT NULL, correcta TEXT NOT NULL, retroalimentacion TEXT NOT NULL, tag_categoria TEXT, tag_tema TEXT);
+CREATE TABLE IF NOT EXISTS progress (username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE, question_id INTEGER NOT NULL REFERENCES questions(id) ON DELETE CASCADE, due_date DATE NOT NULL, interval INTEGER NOT NULL DEFAULT 1, aciertos INTEGER NOT NULL DEFAULT 0, fallos INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (username, question_id));
+CREATE TABLE IF NOT EXISTS duels (id INTEGER PRIMARY KEY AUTOINCREMENT, challenger_username TEXT NOT NULL REFERENCES users(username), opponent_username TEXT NOT NULL REFERENCES users(username), question_ids TEXT NOT NULL, challenger_score INTEGER, opponent_score INTEGER, status TEXT NOT NULL, winner TEXT, created_at DATETIME NOT NULL);
+CREATE TABLE IF NOT EXISTS activity_log (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL, action_type TEXT NOT NULL, timestamp DATETIME NOT NULL);
+CREATE TABLE IF NOT EXISTS deleted_users_log (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL, deletion_date DATETIME NOT NULL, reason TEXT);
+CREATE TABLE IF NOT EXISTS question_votes (id INTEGER PRIMARY KEY AUTOINCREMENT, user_username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE, question_id INTEGER NOT NULL REFERENCES questions(id) ON DELETE CASCADE, vote_type INTEGER NOT NULL, timestamp DATETIME NOT NULL);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_user_question_vote ON question_votes (user_username, question_id);
+CREATE INDEX IF NOT EXISTS idx_deletion_date ON deleted_users_log (deletion_date DESC);
+CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, last_refill REAL NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_stats (username TEXT PRIMARY KEY REFERENCES users(username) ON DELETE CASCADE, total_aciertos INTEGER NOT NULL DEFAULT 0, total_fallos INTEGER NOT NULL DEFAULT 0, mastered_count INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_topic_stats (username TEXT NOT NULL, topic TEXT NOT NULL, correct INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (username, topic)) WITHOUT ROWID;
+"""
+
+# user_stats: agregados de progress por usuario para el ranking, mantenidos por triggers
+# (incluye los borrados en cascada). Dominada = interval > 7, igual que en el Dashboard.
+USER_STATS_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS trg_progress_stats_ins AFTER INSERT ON progress BEGIN
+    INSERT INTO user_stats (username, total_aciertos, total_fallos, mastered_count)
+    VALUES (NEW.username, NEW.aciertos, NEW.fallos, NEW.interval > 7)
+    ON CONFLICT(username) DO UPDATE SET
+        total_aciertos = total_aciertos + excluded.total_aciertos,
+        total_fallos = total_fallos + excluded.total_fallos,
+        mastered_count = mastered_count + excluded.mastered_count;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_progress_stats_upd AFTER UPDATE OF aciertos, fallos, interval ON progress BEGIN
+    UPDATE user_stats SET
+        total_aciertos = total_aciertos + NEW.aciertos - OLD.aciertos,
+        total_fallos = total_fallos + NEW.fallos - OLD.fallos,
+        mastered_count = mastered_count + (NEW.interval > 7) - (OLD.interval > 7)
+    WHERE username = NEW.username;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_progress_stats_del AFTER DELETE ON progress BEGIN
+    UPDATE user_stats SET
+        total_aciertos = total_aciertos - OLD.aciertos,
+        total_fallos = total_fallos - OLD.fallos,
+        mastered_count = mastered_count - (OLD.interval > 7)
+    WHERE username = OLD.username;
+END;
+"""
+
+# user_topic_stats: aciertos/total por usuario y tema (ADN Temático), a partir de los
+# 'answer_submitted' de activity_log. Mismo filtro de metadata que la consulta original.
+TOPIC_STATS_FILTER = "{row}.action_type = 'answer_submitted' AND CASE WHEN json_valid({row}.metadata) THEN json_type({row}.metadata) END = 'object'"
+TOPIC_STATS_TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS trg_activity_topic_ins AFTER INSERT ON activity_log
+WHEN {TOPIC_STATS_FILTER.format(row='NEW')} BEGIN
+    INSERT INTO user_topic_stats (username, topic, correct, total)
+    VALUES (NEW.username, COALESCE(json_extract(NEW.metadata, '$.topic'), 'General'),
+            json_extract(NEW.metadata, '$.result') IS 'correct', 1)
+    ON CONFLICT(username, topic) DO UPDATE SET
+        correct = correct + excluded.correct,
+        total = total + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_activity_topic_del AFTER DELETE ON activity_log
+WHEN {TOPIC_STATS_FILTER.format(row='OLD')} BEGIN
+    UPDATE user_topic_stats SET
+        correct = correct - (json_extract(OLD.metadata, '$.result') IS 'correct'),
+        total = total - 1
+    WHERE username = OLD.username AND topic = COALESCE(json_extract(OLD.metadata, '$.topic'), 'General');
+END;
+"""
+
+# Columnas añadidas después de crear cada tabla: (nombre, definición), en orden de migración
+SCHEMA_MIGRATIONS = {
+    'users': [
+        ('is_approved', 'INTEGER NOT NULL DEFAULT 0'),
+        ('is_intensive', 'INTEGER NOT NULL DEFAULT 0'),
+        ('max_inactivity_days', 'INTEGER NOT NULL DEFAULT 3'),
+        ('status', "TEXT NOT NULL DEFAULT 'active'"),
+        ('is_resident', 'INTEGER NOT NULL DEFAULT 0'),
+        ('intensive_start_date', 'DATE'),
+        ('total_active_days', 'INTEGER NOT NULL DEFAULT 0'),
+        ('current_streak', 'INTEGER NOT NULL DEFAULT 0'),
+        ('last_active_date', 'DATE'),
+        ('last_streak_date', 'DATE'),
+        ('is_reference_model', 'INTEGER DEFAULT 0'),
+        ('final_exam_score', 'INTEGER DEFAULT NULL'),
+        ('cohort_year', 'TEXT DEFAULT NULL'),
+        ('target_exam_date', 'DATE DEFAULT NULL'),
+        ('admitted_status', "TEXT DEFAULT 'Pending'"),
+        ('admitted_specialty', 'TEXT DEFAULT NULL'),
+        ('final_accuracy_snapshot', 'REAL DEFAULT 0.0'),
+        ('avg_daily_questions', 'REAL DEFAULT 0.0'),
+        ('avg_seconds_per_question', 'REAL DEFAULT 0.0'),
+        ('total_questions_snapshot', 'INTEGER DEFAULT 0'),
+        # Seguridad (Anti-Fuerza Bruta)
+        ('failed_attempts', 'INTEGER NOT NULL DEFAULT 0'),
+        ('lockout_until', 'DATETIME DEFAULT NULL'),
+    ],
+    'questions': [
+        ('status', "TEXT NOT NULL DEFAULT 'active'"),
+        ('karma', 'INTEGER NOT NULL DEFAULT 0'),  # Karma/Votos
+    ],
+    # FSRS
+    'progress': [
+        ('stability', 'REAL NOT NULL DEFAULT 0.0'),
+        ('difficulty', 'REAL NOT NULL DEFAULT 0.0'),
+        ('retrievability', 'REAL NOT NULL DEFAULT 0.0'),
+        ('last_review', 'DATE'),
+    ],
+    'activity_log': [
+        ('metadata', 'TEXT'),
+    ],
+}
+
+@st.cache_resource(show_spinner=False)
 def setup_database():
+    """
+    Crea y migra la base de datos una sola vez por proceso (no en cada rerun),
+    con una conexión propia que se cierra al terminar.
+    """
+    with closing(_open_db_conn()) as conn:
+        _migrate_database(conn)
+    return True
+
+def _migrate_database(conn):
     """
     Crea y migra la base de datos de forma segura. Verifica la existencia de todas
     las tablas y columnas necesarias y las añade si no existen.
     """
-    conn = get_db_conn()
     cursor = conn.cursor()
+
+    # auto_vacuum INCREMENTAL: las páginas que liberan los DELETE se pueden devolver al disco
+    # sin un VACUUM completo. Cambiarlo exige un VACUUM (una sola vez; en BD nueva es instantáneo).
+    if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
     
     # --- Creación de Tablas (si no existen) ---
-    cursor.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password_hash TEXT NOT NULL, role TEXT NOT NULL DEFAULT 'user');")
-    cursor.execute("CREATE TABLE IF NOT EXISTS questions (id INTEGER PRIMARY KEY AUTOINCREMENT, owner_username TEXT NOT NULL REFERENCES users(username), enunciado TEXT NOT NULL, opciones TEXT NOT NULL, correcta TEXT NOT NULL, retroalimentacion TEXT NOT NULL, tag_categoria TEXT, tag_tema TEXT);")
-    cursor.execute("CREATE TABLE IF NOT EXISTS progress (username TEXT NOT NULL REFERENCES users(username), question_id INTEGER NOT NULL REFERENCES questions(id) ON DELETE CASCADE, due_date DATE NOT NULL, interval INTEGER NOT NULL DEFAULT 1, aciertos INTEGER NOT NULL DEFAULT 0, fallos INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (username, question_id));")
-    cursor.execute("CREATE TABLE IF NOT EXISTS duels (id INTEGER PRIMARY KEY AUTOINCREMENT, challenger_username TEXT NOT NULL REFERENCES users(username), opponent_username TEXT NOT NULL REFERENCES users(username), question_ids TEXT NOT NULL, challenger_score INTEGER, opponent_score INTEGER, status TEXT NOT NULL, winner TEXT, created_at DATETIME NOT NULL);")
-    cursor.execute("CREATE TABLE IF NOT EXISTS activity_log (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL, action_type TEXT NOT NULL, timestamp DATETIME NOT NULL);")
-    cursor.execute("CREATE TABLE IF NOT EXISTS deleted_users_log (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL, deletion_date DATETIME NOT NULL, reason TEXT);")
-    cursor.execute("CREATE TABLE IF NOT EXISTS question_votes (id INTEGER PRIMARY KEY AUTOINCREMENT, user_username TEXT NOT NULL REFERENCES users(username), question_id INTEGER NOT NULL REFERENCES questions(id), vote_type INTEGER NOT NULL, timestamp DATETIME NOT NULL);")
-    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_question_vote ON question_votes (user_username, question_id);")
+    had_user_stats = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'").fetchone()
+    had_topic_stats = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_topic_stats'").fetchone()
+    # Un solo script: SQLite lo analiza de una pasada en vez de una llamada por sentencia
+    cursor.executescript(SCHEMA_DDL)
+    # user_throttle era la tabla de throttle por usuario previa a rate_buckets; las BD
+    # antiguas todavía pueden tenerla
+    cursor.execute("DROP TABLE IF EXISTS user_throttle")
+
+    # Índices para las consultas calientes (puntaje por ventana, votos, telemetría y duelos)
+    hot_indexes = {
+        'idx_activity_user_time': "CREATE INDEX idx_activity_user_time ON activity_log (username, timestamp, action_type);",
+        'idx_votes_qid_type': "CREATE INDEX idx_votes_qid_type ON question_votes (question_id, vote_type);",
+        # Telemetría del panel de admin: respuestas de un usuario en orden de id
+        'idx_activity_user_type_id': "CREATE INDEX idx_activity_user_type_id ON activity_log (username, action_type, id);",
+        # Victorias/derrotas y ranking de duelos
+        'idx_duels_winner': "CREATE INDEX idx_duels_winner ON duels (winner);",
+        # Último evento de un tipo (verify_db_telemetry): el rowid va implícito al final del
+        # índice, así que action_type = ? ORDER BY id DESC LIMIT 1 es un solo salto
+        'idx_activity_action': "CREATE INDEX idx_activity_action ON activity_log (action_type);",
+    }
+    existing_indexes = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    missing_indexes = [name for name in hot_indexes if name not in existing_indexes]
+    for name in missing_indexes:
+        cursor.execute(hot_indexes[name])
+    # El índice nuevo de activity_log cubre al anterior (mismo prefijo)
+    cursor.execute("DROP INDEX IF EXISTS idx_activity_user_ts;")
+    if missing_indexes:
+        # Estadísticas inmediatas para que el planificador los use desde ya
+        cursor.execute("ANALYZE")
 
     # --- Migraciones Seguras de Columnas ---
-    
-    def add_column_if_not_exists(table, column_name, column_def):
-        """Función auxiliar para añadir una columna de forma idempotente."""
-        cursor.execute(f"PRAGMA table_info({table})")
-        existing_columns = [col[1] for col in cursor.fetchall()]
-        if column_name not in existing_columns:
-            st.warning(f"Migrando BD: Añadiendo columna '{column_name}' a tabla '{table}'...")
-            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column_name} {column_def}")
-
-    # Migraciones para la tabla 'users'
-    add_column_if_not_exists('users', 'is_approved', 'INTEGER NOT NULL DEFAULT 0')
-    add_column_if_not_exists('users', 'is_intensive', 'INTEGER NOT NULL DEFAULT 0')
-    add_column_if_not_exists('users', 'max_inactivity_days', 'INTEGER NOT NULL DEFAULT 3')
-    add_column_if_not_exists('users', 'status', "TEXT NOT NULL DEFAULT 'active'")
-    add_column_if_not_exists('users', 'is_resident', 'INTEGER NOT NULL DEFAULT 0')
-    add_column_if_not_exists('users', 'intensive_start_date', 'DATE')
-    add_column_if_not_exists('users', 'total_active_days', 'INTEGER NOT NULL DEFAULT 0')
-    add_column_if_not_exists('users', 'current_streak', 'INTEGER NOT NULL DEFAULT 0')
-    add_column_if_not_exists('users', 'last_active_date', 'DATE')
-    add_column_if_not_exists('users', 'last_streak_date', 'DATE')
-    add_column_if_not_exists('users', 'is_reference_model', 'INTEGER DEFAULT 0')
-    add_column_if_not_exists('users', 'final_exam_score', 'INTEGER DEFAULT NULL')
-    add_column_if_not_exists('users', 'cohort_year', 'TEXT DEFAULT NULL')
-    add_column_if_not_exists('users', 'target_exam_date', 'DATE DEFAULT NULL')
-    add_column_if_not_exists('users', 'admitted_status', "TEXT DEFAULT 'Pending'")
-    add_column_if_not_exists('users', 'admitted_specialty', 'TEXT DEFAULT NULL')
-    add_column_if_not_exists('users', 'final_accuracy_snapshot', 'REAL DEFAULT 0.0')
-    add_column_if_not_exists('users', 'avg_daily_questions', 'REAL DEFAULT 0.0')
-    add_column_if_not_exists('users', 'avg_seconds_per_question', 'REAL DEFAULT 0.0')
-    add_column_if_not_exists('users', 'total_questions_snapshot', 'INTEGER DEFAULT 0')
-
-    # --- INICIO: Migraciones de Seguridad (Anti-Fuerza Bruta) ---
-    add_column_if_not_exists('users', 'failed_attempts', 'INTEGER NOT NULL DEFAULT 0')
-    add_column_if_not_exists('users', 'lockout_until', 'DATETIME DEFAULT NULL')
-    # --- FIN: Migraciones de Seguridad ---
-
-    # Migraciones para la tabla 'questions'
-    add_column_if_not_exists('questions', 'status', "TEXT NOT NULL DEFAULT 'active'")
-    add_column_if_not_exists('questions', 'karma', 'INTEGER NOT NULL DEFAULT 0') # Columna para Karma/Votos
-
-    # Migraciones para la tabla 'progress' (FSRS)
-    add_column_if_not_exists('progress', 'stability', 'REAL NOT NULL DEFAULT 0.0')
-    add_column_if_not_exists('progress', 'difficulty', 'REAL NOT NULL DEFAULT 0.0')
-    add_column_if_not_exists('progress', 'retrievability', 'REAL NOT NULL DEFAULT 0.0')
-    add_column_if_not_exists('progress', 'last_review', 'DATE')
-
-    # Migración para la tabla 'activity_log'
-    add_column_if_not_exists('activity_log', 'metadata', 'TEXT')
+    # Un solo PRAGMA table_info por tabla; solo se emiten los ALTER que falten, en una transacción
+    cursor.execute("BEGIN")
+    for table, columns in SCHEMA_MIGRATIONS.items():
+        existing_columns = {col[1] for col in cursor.execute(f"PRAGMA table_info({table})")}
+        for column_name, column_def in columns:
+            if column_name not in existing_columns:
+                st.warning(f"Migrando BD: Añadiendo columna '{column_name}' a tabla '{table}'...")
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column_name} {column_def}")
+    conn.commit()
+
+    # --- Reconstrucción de Tablas (BDs creadas antes de cada cambio de esquema) ---
+
+    def table_sql(table):
+        row = cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+        return row[0].strip() if row else None
+
+    def rebuild_table(table, new_sql, reason):
+        """
+        Reconstruye una tabla con otro DDL (una sola vez): copia las filas y recrea sus índices.
+        `new_sql` es el DDL completo de la tabla original (incluye columnas añadidas con ALTER).
+        """
+        new_sql = re.sub(rf'^CREATE TABLE\s+["`\[]?{table}["`\]]?', f'CREATE TABLE {table}_new', new_sql, count=1, flags=re.IGNORECASE)
+        index_sqls = [r[0] for r in cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))]
+        st.warning(f"Migrando BD: Reconstruyendo tabla '{table}' {reason}...")
+        conn.commit()
+        cursor.execute("PRAGMA foreign_keys = OFF")
+        try:
+            cursor.executescript(f"""
+                BEGIN;
+                {new_sql};
+                INSERT INTO {table}_new SELECT * FROM {table};
+                DROP TABLE {table};
+                ALTER TABLE {table}_new RENAME TO {table};
+                {';'.join(index_sqls)};
+                COMMIT;
+            """)
+        except sqlite3.Error as e:
+            # Ej. PK nula heredada (permitida en tablas con rowid): se deja la tabla como estaba
+            conn.rollback()
+            print(f"⚠️ No se pudo reconstruir '{table}' {reason}: {e}")
+        finally:
+            cursor.execute("PRAGMA foreign_keys = ON")
+
+    # users: PK de texto como WITHOUT ROWID
+    users_sql = table_sql('users')
+    if users_sql and 'WITHOUT ROWID' not in users_sql.upper():
+        rebuild_table('users', f"{users_sql} WITHOUT ROWID", "como WITHOUT ROWID")
+
+    # progress / question_votes: sus filas se borran en cascada con el usuario o la pregunta
+    for table in ('progress', 'question_votes'):
+        old_sql = table_sql(table)
+        if not old_sql:
+            continue
+        cascade_sql = re.sub(
+            r'(REFERENCES\s+(?:users\s*\(\s*username\s*\)|questions\s*\(\s*id\s*\)))(?!\s+ON\s+DELETE)',
+            r'\1 ON DELETE CASCADE', old_sql, flags=re.IGNORECASE)
+        if cascade_sql != old_sql:
+            rebuild_table(table, cascade_sql, "con ON DELETE CASCADE")
+
+    # --- Agregados del ranking (user_stats) ---
+    # Después de las reconstrucciones: reconstruir progress borra sus triggers
+    cursor.executescript(USER_STATS_TRIGGERS)
+    if not had_user_stats:
+        # Tabla recién creada: carga inicial desde progress (después, solo los triggers la tocan)
+        with conn:
+            conn.execute("""
+                INSERT INTO user_stats (username, total_aciertos, total_fallos, mastered_count)
+                SELECT username, SUM(aciertos), SUM(fallos), SUM(interval > 7)
+                FROM progress GROUP BY username
+            """)
+
+    # --- Agregados del ADN Temático (user_topic_stats) ---
+    # Después de las migraciones: los triggers leen activity_log.metadata
+    cursor.executescript(TOPIC_STATS_TRIGGERS)
+    if not had_topic_stats:
+        with conn:
+            conn.execute(f"""
+                INSERT INTO user_topic_stats (username, topic, correct, total)
+                SELECT username, COALESCE(json_extract(metadata, '$.topic'), 'General') AS topic,
+                       SUM(json_extract(metadata, '$.result') IS 'correct'), COUNT(*)
+                FROM activity_log a
+                WHERE {TOPIC_STATS_FILTER.format(row='a')}
+                GROUP BY username, topic
+            """)
+
+    # --- Índices sobre columnas añadidas por migración ---
+    # Parcial: solo indexa a los condenados, que son los que busca la Zona de Juicio
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_pending ON users (status) WHERE status = 'pending_delete';")
+    # Cola SRS: adelantos por usuario en orden de vencimiento (cubre last_review y question_id)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_progress_user_due ON progress (username, due_date, last_review, question_id);")
+    # Radar, conteo por categoría y práctica por categoría: status + tag_categoria en el índice.
+    # Cubre al antiguo idx_questions_status (mismo prefijo).
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_questions_status_cat ON questions (status, tag_categoria);")
+    cursor.execute("DROP INDEX IF EXISTS idx_questions_status;")
+    # "Mis Preguntas" y el traspaso de preguntas al purgar usuarios filtran por autor
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_questions_owner_status ON questions (owner_username, status);")
+    # Práctica por tema: conteo y salto aleatorio sobre el índice
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_q_tag_status ON questions (tag_tema, status);")
+    # Parcial: solo el Usuario Fantasma (modelo de referencia) que busca get_ghost_profile
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reference_model ON users (username) WHERE is_reference_model = 1;")
 
     # --- Configuración del Admin por Defecto ---
     try:
@@ -137,8 +529,7 @@ def setup_database():
     admin = cursor.fetchone()
     
     if not admin:
-        admin_pass_bytes = ADMIN_PASS_DEFAULT.encode('utf-8')[:72]
-        admin_pass_hash = pwd_context.hash(admin_pass_bytes)
+        admin_pass_hash = pwd_context.hash(ADMIN_PASS_DEFAULT)
         cursor.execute(
             "INSERT INTO users (username, password_hash, role, is_approved) VALUES (?, ?, 'admin', 1)",
             (ADMIN_USER_DEFAULT, admin_pass_hash)
@@ -147,89 +538,150 @@ def setup_database():
         cursor.execute("UPDATE users SET is_approved = 1, role = 'admin' WHERE username = ?", (ADMIN_USER_DEFAULT,))
 
     conn.commit()
-    conn.close()
 
 # --- FUNCIONES DE AUTENTICACIÓN Y HASHING ---
 
+PASSWORD_CACHE_SIZE = 256  # Resultados de verificación recordados por proceso
+
+@st.cache_resource(show_spinner=False)
+def _password_verify_cache():
+    """
+    Resultados recientes de argon2 por proceso. La clave es (HMAC de la contraseña con
+    una clave aleatoria del proceso, hash guardado): nunca se guarda la contraseña en claro,
+    y cambiar la contraseña (otro hash) invalida la entrada.
+    """
+    return {"key": secrets.token_bytes(32), "results": collections.OrderedDict(), "lock": threading.Lock()}
+
 def verify_password(plain_password, hashed_password):
-    """Verifica la contraseña plana contra el hash."""
-    return pwd_context.verify(plain_password, hashed_password)
+    """Verifica la contraseña plana contra el hash (argon2 solo si no está en la caché)."""
+    cache = _password_verify_cache()
+    digest = hmac.new(cache["key"], plain_password.encode('utf-8'), hashlib.sha256).digest()
+    cache_key = (digest, hashed_password)
+    with cache["lock"]:
+        result = cache["results"].get(cache_key)
+        if result is not None:
+            cache["results"].move_to_end(cache_key)
+            return result
+
+    result = pwd_context.verify(plain_password, hashed_password)
+    with cache["lock"]:
+        cache["results"][cache_key] = result
+        if len(cache["results"]) > PASSWORD_CACHE_SIZE:
+            cache["results"].popitem(last=False)
+    return result
 
 def get_user_role(username):
     """Obtiene el rol (admin/user) de un usuario."""
     conn = get_db_conn()
-    cursor = conn.cursor()
-    cursor.execute("SELECT role FROM users WHERE username = ?", (username,))
-    result = cursor.fetchone()
-    conn.close()
+    result = conn.execute(SQL_USER_ROLE, (username,)).fetchone()
     return result['role'] if result else None
 
-def delete_user_from_db(username):
+@st.cache_data(ttl=300, show_spinner=False)
+def load_user_list():
+    """Nombres de usuario para los selectores del admin. Registrar o borrar usuarios la invalida."""
+    with db_conn() as conn:
+        return [row[0] for row in conn.execute("SELECT username FROM users ORDER BY username")]
+
+def _purge_users_rows(cursor, usernames, admin_user):
     """
-    Elimina un usuario, transfiere sus preguntas al admin y limpia datos asociados.
-    Sigue una lógica de expropiación para no perder contenido comunitario valioso.
+    Borra los datos personales de uno o varios usuarios y transfiere sus preguntas al admin.
+    Un solo DELETE ... IN (...) por tabla, sin importar cuántos usuarios sean. No hace commit;
+    tras confirmar, el llamador debe invocar clear_purged_user_caches().
+    """
+    placeholders = ",".join("?" * len(usernames))
+    params = tuple(usernames)
+    # 3. Limpieza de Datos Personales (Borrar)
+    # Eliminar participaciones en duelos
+    cursor.execute(f"DELETE FROM duels WHERE challenger_username IN ({placeholders}) OR opponent_username IN ({placeholders})", params + params)
+    # Eliminar el historial de actividad
+    cursor.execute(f"DELETE FROM activity_log WHERE username IN ({placeholders})", params)
+
+    # 4. Preservación de Contenido (Transferir)
+    # Actualizar el propietario de las preguntas para que pertenezcan al admin
+    cursor.execute(f"UPDATE questions SET owner_username = ? WHERE owner_username IN ({placeholders})", (admin_user,) + params)
+
+    # 5. Eliminación de Cuenta
+    # Finalmente, eliminar el registro del usuario (progreso y votos se borran en cascada)
+    cursor.execute(f"DELETE FROM users WHERE username IN ({placeholders})", params)
+
+def clear_purged_user_caches():
+    """
+    Invalida las cachés que dependen de los usuarios borrados. Se llama DESPUÉS del commit:
+    antes, otra sesión podría volver a llenarlas con los datos viejos.
     """
+    load_user_list.clear()
+    get_ghost_profile.clear()
+    # Sus preguntas pasaron al admin: las tarjetas cacheadas aún muestran al autor anterior
+    load_question.clear()
+
+def _get_admin_username():
+    """Usuario administrador principal (nunca se elimina)."""
     try:
-        # 1. Identificar al Admin
-        admin_user = st.secrets["ADMIN_USER"]
+        return st.secrets["ADMIN_USER"]
     except KeyError:
         # Fallback para entorno local donde los secrets no están definidos
-        admin_user = "admin"
+        return "admin"
+
+def delete_user_from_db(username, conn=None):
+    """
+    Elimina un usuario, transfiere sus preguntas al admin y limpia datos asociados.
+    Sigue una lógica de expropiación para no perder contenido comunitario valioso.
+    Si se pasa `conn`, el borrado corre dentro de la transacción del llamador
+    (sin commit propio) para que sea atómico con sus otras escrituras.
+    Devuelve True si el usuario fue eliminado.
+    """
+    # 1. Identificar al Admin
+    admin_user = _get_admin_username()
 
     # 2. Validación: No eliminar al admin
     if username == admin_user:
         st.error(f"No se puede eliminar al usuario administrador principal ('{admin_user}').")
-        return
+        return False
+
+    if conn is not None:
+        # El commit/rollback lo gestiona el `with conn:` del llamador, que limpia las cachés al salir
+        _purge_users_rows(conn.cursor(), [username], admin_user)
+        st.success(f"Usuario '{username}' eliminado. Sus preguntas han sido transferidas al admin '{admin_user}'.")
+        return True
 
-    conn = None
+    conn = get_db_conn()
     try:
-        conn = get_db_conn()
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA foreign_keys = ON")
-        # Iniciar transacción
-        cursor.execute("BEGIN TRANSACTION")
-
-        # 3. Limpieza de Datos Personales (Borrar)
-        # Eliminar participaciones en duelos
-        cursor.execute("DELETE FROM duels WHERE challenger_username = ? OR opponent_username = ?", (username, username))
-        # Eliminar todo el progreso de estudio
-        cursor.execute("DELETE FROM progress WHERE username = ?", (username,))
-        # Eliminar todos los votos emitidos por el usuario
-        cursor.execute("DELETE FROM question_votes WHERE user_username = ?", (username,))
-        # Eliminar el historial de actividad
-        cursor.execute("DELETE FROM activity_log WHERE username = ?", (username,))
-
-        # 4. Preservación de Contenido (Transferir)
-        # Actualizar el propietario de las preguntas para que pertenezcan al admin
-        cursor.execute("UPDATE questions SET owner_username = ? WHERE owner_username = ?", (admin_user, username))
-
-        # 5. Eliminación de Cuenta
-        # Finalmente, eliminar el registro del usuario
-        cursor.execute("DELETE FROM users WHERE username = ?", (username,))
-
-        # Confirmar la transacción si todo fue exitoso
-        conn.commit()
+        # `with conn:` confirma la transacción si todo fue exitoso y la revierte si algo falla
+        with conn:
+            _purge_users_rows(conn.cursor(), [username], admin_user)
+        clear_purged_user_caches()
 
         st.success(f"Usuario '{username}' eliminado. Sus preguntas han sido transferidas al admin '{admin_user}'.")
+        return True
 
     except sqlite3.Error as e:
-        if conn:
-            conn.rollback()  # Revertir cambios en caso de error de base de datos
         st.error(f"Error de base de datos al eliminar usuario: {e}")
     except Exception as e:
-        if conn:
-            conn.rollback()  # Revertir también en caso de otro tipo de error
         st.error(f"Ocurrió un error inesperado durante la eliminación: {e}")
-    finally:
-        if conn:
-            conn.close()
+    return False
+
+
+def reclaim_free_pages(conn, pages=1000):
+    """Devuelve al disco hasta `pages` páginas libres (auto_vacuum incremental). Fuera de transacción."""
+    # fetchall(): el PRAGMA libera páginas de a una por paso; hay que consumirlo entero
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+
+def delete_users_from_db(usernames, conn):
+    """
+    Ejecución en lote: mismo borrado que delete_user_from_db para varios usuarios a la vez,
+    dentro de la transacción del llamador. Devuelve la lista de usuarios eliminados.
+    """
+    admin_user = _get_admin_username()
+    targets = [u for u in usernames if u != admin_user]
+    if targets:
+        _purge_users_rows(conn.cursor(), targets, admin_user)
+    return targets
 
 
 def log_event(user_id, event_type, metadata_dict=None):
     """
     Registra un evento genérico en el activity_log con metadatos JSON.
     """
-    conn = None
     try:
         # Asegura que los metadatos sean un diccionario antes de procesar
         if metadata_dict is None:
@@ -239,14 +691,13 @@ def log_event(user_id, event_type, metadata_dict=None):
         meta_json = json.dumps(metadata_dict)
         
         conn = get_db_conn()
-        cursor = conn.cursor()
         
         # Inserta el nuevo evento incluyendo los metadatos.
-        cursor.execute(
-            "INSERT INTO activity_log (username, action_type, timestamp, metadata) VALUES (?, ?, ?, ?)",
-            (user_id, event_type, datetime.datetime.now(), meta_json)
-        )
-        conn.commit()
+        with conn:
+            conn.execute(
+                SQL_LOG_INSERT,
+                (user_id, event_type, datetime.datetime.now(), meta_json)
+            )
     
     except sqlite3.Error as e:
         # Error específico de la base de datos
@@ -257,92 +708,80 @@ def log_event(user_id, event_type, metadata_dict=None):
     except Exception as e:
         # Cualquier otro error inesperado
         print(f"Error inesperado al registrar evento: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 # --- PÁGINAS DE LA APLICACIÓN ---
 
 # --- INICIO SECCIÓN DE FEATURES: Votos y Modo Intensivo ---
 
 def cast_vote(conn, username, question_id, vote_type):
-    """Registra o actualiza el voto de un usuario y activa la guillotina si es necesario."""
-    cursor = conn.cursor()
+    """
+    Registra o actualiza el voto de un usuario y activa la guillotina si es necesario.
+    Devuelve el cambio que produce en el karma de la pregunta (voto nuevo - voto anterior).
+    """
+    previous = conn.execute(SQL_USER_VOTE, (username, question_id)).fetchone()
+    delta = vote_type - (previous[0] if previous else 0)
 
     # Usamos INSERT OR REPLACE para manejar el UPSERT basado en el índice UNIQUE
-    cursor.execute("""
-        INSERT OR REPLACE INTO question_votes (user_username, question_id, vote_type, timestamp)
-        VALUES (?, ?, ?, ?)
-    """, (username, question_id, vote_type, datetime.datetime.now()))
+    conn.execute(SQL_UPSERT_VOTE, (username, question_id, vote_type, datetime.datetime.now()))
 
     # --- Lógica del Gatillo (La Guillotina) ---
     if vote_type == -1:
         # Contar los votos negativos para esta pregunta
-        unlike_count = cursor.execute(
-            "SELECT COUNT(*) FROM question_votes WHERE question_id = ? AND vote_type = -1",
-            (question_id,)
-        ).fetchone()[0]
+        unlike_count = conn.execute(SQL_COUNT_UNLIKES, (question_id,)).fetchone()[0]
         
         # La Regla: Si hay 3 o más 'unlikes', la pregunta necesita revisión
         if unlike_count >= 3:
-            cursor.execute("UPDATE questions SET status = 'needs_revision' WHERE id = ?", (question_id,))
+            conn.execute("UPDATE questions SET status = 'needs_revision' WHERE id = ?", (question_id,))
             st.toast(f"Pregunta {question_id} enviada a revisión por votos negativos.")
 
+    return delta
+
 def update_karma(conn, username, question_id, vote_type):
     """
     Gestiona el voto de un usuario y actualiza el contador de karma denormalizado
     en la tabla de preguntas dentro de una única transacción.
     """
-    # 1. Registrar el voto individual
-    cast_vote(conn, username, question_id, vote_type)
-    
-    # 2. Recalcular el karma total
-    # Contamos los likes (1) y restamos los unlikes (-1)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT SUM(vote_type) FROM question_votes WHERE question_id = ?",
-        (question_id,)
-    )
-    new_karma = cursor.fetchone()[0] or 0
-    
-    # 3. Actualizar el contador denormalizado en la tabla de preguntas
-    cursor.execute(
-        "UPDATE questions SET karma = ? WHERE id = ?",
-        (new_karma, question_id)
-    )
+    # 1. Registrar el voto individual (devuelve cuánto cambia el karma)
+    delta = cast_vote(conn, username, question_id, vote_type)
+
+    # 2. Aplicar el cambio al contador denormalizado, sin recontar todos los votos
+    if delta:
+        conn.execute(SQL_ADD_KARMA, (delta, question_id))
 
 def get_question_votes(question_id):
     """Obtiene el conteo de likes y unlikes para una pregunta."""
     conn = get_db_conn()
-    # Usamos COALESCE para asegurar que devolvemos 0 si no hay votos de un tipo
-    query = """
-        SELECT 
-            COALESCE(SUM(CASE WHEN vote_type = 1 THEN 1 ELSE 0 END), 0) as likes,
-            COALESCE(SUM(CASE WHEN vote_type = -1 THEN 1 ELSE 0 END), 0) as unlikes
-        FROM question_votes
-        WHERE question_id = ?
-    """
-    votes = conn.execute(query, (question_id,)).fetchone()
-    conn.close()
+    # COALESCE asegura 0 si no hay votos de un tipo
+    votes = conn.execute(SQL_QUESTION_VOTES, (question_id,)).fetchone()
     
     return votes['likes'], votes['unlikes']
 
 def has_user_voted(username, question_id):
     """Verifica si un usuario ya ha votado por una pregunta específica."""
     conn = get_db_conn()
-    vote = conn.execute(
-        "SELECT 1 FROM question_votes WHERE user_username = ? AND question_id = ?",
-        (username, question_id)
-    ).fetchone()
-    conn.close()
+    # Misma sentencia que usa cast_vote: una sola entrada en la caché de sentencias
+    vote = conn.execute(SQL_USER_VOTE, (username, question_id)).fetchone()
     return vote is not None
 
-def calculate_user_score(username, days_limit=3):
-    """Calcula el puntaje de actividad de un usuario, respetando la fecha de inicio del modo intensivo."""
-    conn = get_db_conn()
-    
-    # 1. Obtener fecha de inicio del desafío
-    user = conn.execute("SELECT intensive_start_date FROM users WHERE username = ?", (username,)).fetchone()
+@functools.lru_cache(maxsize=1024)
+def parse_intensive_start(start_str):
+    """
+    Convierte intensive_start_date (YYYY-MM-DD, o con hora) a datetime. fromisoformat
+    acepta ambos formatos y está en C; el resultado se cachea por texto.
+    """
+    return datetime.datetime.fromisoformat(start_str)
+
+def calculate_user_score(username, days_limit=3, conn=None, user=None):
+    """
+    Calcula el puntaje de actividad de un usuario, respetando la fecha de inicio del modo intensivo.
+    Si el llamador ya tiene la conexión o la fila del usuario (con intensive_start_date), se reutilizan.
+    """
+    if conn is None:
+        conn = get_db_conn()
+
+    # 1. Obtener fecha de inicio del desafío (salvo que ya venga en la fila)
+    if user is None:
+        user = conn.execute("SELECT intensive_start_date FROM users WHERE username = ?", (username,)).fetchone()
     
     # Calculamos el inicio de la ventana deslizante estándar (hace X días)
     window_start = datetime.datetime.now() - datetime.timedelta(days=days_limit)
@@ -355,44 +794,57 @@ def calculate_user_score(username, days_limit=3):
         start_str = user['intensive_start_date']
         
         try:
-            # El formato guardado es YYYY-MM-DD
-            intensive_start = datetime.datetime.strptime(start_str, '%Y-%m-%d')
+            intensive_start = parse_intensive_start(start_str)
             # EL PARCHE: Usamos la fecha más reciente.
             # Si activó el modo hace 1 hora, start_date_filter será hace 1 hora (0 puntos previos).
             # Si activó hace 1 mes, start_date_filter será hace 3 días.
             start_date_filter = max(intensive_start, window_start)
         except (ValueError, TypeError) as e:
-             # Fallback por si la fecha tuviera un formato con hora
-            try:
-                intensive_start = datetime.datetime.strptime(start_str, '%Y-%m-%d %H:%M:%S')
-                start_date_filter = max(intensive_start, window_start)
-            except Exception as e2:
-                print(f"⚠️ Error parseando fecha intensiva (formatos '%Y-%m-%d' y '%Y-%m-%d %H:%M:%S'): {e} / {e2}")
-
-    # 3. Contar puntos (Answer=1, Create=2)
+            print(f"⚠️ Error parseando fecha intensiva (formatos '%Y-%m-%d' y '%Y-%m-%d %H:%M:%S'): {e}")
+
+    # 3. Contar puntos (Answer=1, Create=2), agregando en SQL
     query = """
-        SELECT action_type 
-        FROM activity_log 
-        WHERE username = ? 
+        SELECT
+            SUM(CASE WHEN action_type IN ('answer', 'answer_submitted') THEN 1 ELSE 0 END) AS respuestas,
+            SUM(CASE WHEN action_type = 'create' THEN 1 ELSE 0 END) AS creadas
+        FROM activity_log
+        WHERE username = ?
           AND timestamp >= ?
     """
-    logs = conn.execute(query, (username, start_date_filter)).fetchall()
-    conn.close()
-
-    score = 0
-    num_creadas = 0
-    num_respuestas = 0
-    for log in logs:
-        action = log['action_type']
-        if action in ['answer', 'answer_submitted']:
-            score += 1
-            num_respuestas += 1
-        elif action == 'create':
-            score += 2
-            num_creadas += 1
+    row = conn.execute(query, (username, start_date_filter)).fetchone()
+    num_respuestas = row['respuestas'] or 0
+    num_creadas = row['creadas'] or 0
+    score = num_respuestas + 2 * num_creadas
 
     return score, num_creadas, num_respuestas
 
+@st.cache_data(ttl=60, show_spinner=False)
+def get_pending_deletion_scores(pending_key, latest_activity_id):
+    """
+    Devuelve los usuarios 'pending_delete' con su puntaje ya calculado en SQL
+    (una sola consulta en vez de llamar a calculate_user_score por usuario).
+    Misma regla: ventana de max_inactivity_days, recortada por intensive_start_date.
+    Cacheado: `pending_key` (condenados + su configuración) y el último id de
+    activity_log forman la clave; el ttl cubre el avance de la ventana de días.
+    """
+    query = """
+        SELECT u.username, u.max_inactivity_days,
+               COALESCE(SUM(CASE
+                   WHEN a.action_type IN ('answer', 'answer_submitted') THEN 1
+                   WHEN a.action_type = 'create' THEN 2
+                   ELSE 0 END), 0) AS score
+        FROM users u
+        LEFT JOIN activity_log a
+               ON a.username = u.username
+              AND a.timestamp >= MAX(
+                      datetime('now', 'localtime', '-' || u.max_inactivity_days || ' days'),
+                      COALESCE(datetime(u.intensive_start_date), ''))
+        WHERE u.status = 'pending_delete'
+        GROUP BY u.username
+    """
+    with db_conn() as conn:
+        return [dict(row) for row in conn.execute(query).fetchall()]
+
 def show_productivity_widget():
     """Muestra un widget de productividad mejorado, visualmente consistente para todos los usuarios en modo intensivo."""
     conn = get_db_conn()
@@ -400,13 +852,12 @@ def show_productivity_widget():
         "SELECT is_intensive, max_inactivity_days, intensive_start_date FROM users WHERE username = ?",
         (st.session_state.current_user,)
     ).fetchone()
-    conn.close()
 
     if not (user_settings and user_settings['is_intensive']):
         return
 
     days_limit = user_settings['max_inactivity_days']
-    score, _, _ = calculate_user_score(st.session_state.current_user, days_limit)
+    score, _, _ = calculate_user_score(st.session_state.current_user, days_limit, conn=conn, user=user_settings)
 
     st.sidebar.markdown("---")
     st.sidebar.subheader("🔥 Modo Intensivo Activo")
@@ -415,7 +866,7 @@ def show_productivity_widget():
     is_in_grace_period = False
     days_active = 0
     if user_settings['intensive_start_date']:
-        start_date = datetime.datetime.strptime(user_settings['intensive_start_date'], '%Y-%m-%d').date()
+        start_date = parse_intensive_start(user_settings['intensive_start_date']).date()
         days_active = (datetime.date.today() - start_date).days
         if days_active < days_limit:
             is_in_grace_period = True
@@ -445,6 +896,42 @@ def show_productivity_widget():
 # --- FIN SECCIÓN DE FEATURES ---
 
 
+# --- Datos y gráficos fijos del Reglamento (no cambian entre renders) ---
+DATOS_APRENDIZAJE = {
+    'Estado': ['Aprendido (Largo Plazo)', 'Por Aprender'],
+    'Cantidad': [20, 80]
+}
+DATOS_ESTRATEGIAS = {
+    'Estrategia': ['Solo Responder', 'Solo Crear', 'Mix Equilibrado'],
+    'Acciones Necesarias': [30, 15, 20], # 30 respuestas, 15 creadas, 10 creadas + 10 respondidas = 20 acciones
+    'Detalle': ['30 Respuestas', '15 Preguntas Creadas', '10 Creadas + 10 Respuestas']
+}
+
+@st.cache_resource(show_spinner=False)
+def _chart_aprendizaje():
+    """Gráfico de torta de ejemplo (Tasa de Aprendizaje). Se construye una vez por proceso."""
+    import pandas as pd
+    return alt.Chart(pd.DataFrame(DATOS_APRENDIZAJE)).mark_arc(innerRadius=50).encode(
+        theta=alt.Theta(field="Cantidad", type="quantitative"),
+        color=alt.Color(field="Estado", type="nominal", scale=alt.Scale(scheme='greens')),
+        tooltip=['Estado', 'Cantidad']
+    ).properties(
+        title='Ej: Tasa de Aprendizaje del 20%'
+    )
+
+@st.cache_resource(show_spinner=False)
+def _chart_estrategias():
+    """Gráfico de barras de estrategias para llegar a 30 puntos. Se construye una vez por proceso."""
+    import pandas as pd
+    return alt.Chart(pd.DataFrame(DATOS_ESTRATEGIAS)).mark_bar().encode(
+        x=alt.X('Estrategia', sort=None, title=''),
+        y=alt.Y('Acciones Necesarias', title='Cantidad de Acciones para llegar a 30 Pts'),
+        color=alt.Color('Estrategia', legend=None),
+        tooltip=['Estrategia', 'Detalle']
+    ).properties(
+        title='Cómo Acumular 30 Puntos'
+    )
+
 def show_rules_page():
     """Crea una página visual para explicar las reglas, métricas y rangos."""
     st.header("📜 Reglamento y Guía de Supervivencia")
@@ -462,18 +949,7 @@ def show_rules_page():
         """)
         
         # Gráfico de Torta para Tasa de Aprendizaje
-        df_aprendizaje = pd.DataFrame({
-            'Estado': ['Aprendido (Largo Plazo)', 'Por Aprender'],
-            'Cantidad': [20, 80]
-        })
-        chart_aprendizaje = alt.Chart(df_aprendizaje).mark_arc(innerRadius=50).encode(
-            theta=alt.Theta(field="Cantidad", type="quantitative"),
-            color=alt.Color(field="Estado", type="nominal", scale=alt.Scale(scheme='greens')),
-            tooltip=['Estado', 'Cantidad']
-        ).properties(
-            title='Ej: Tasa de Aprendizaje del 20%'
-        )
-        st.altair_chart(chart_aprendizaje, use_container_width=True)
+        st.altair_chart(_chart_aprendizaje(), use_container_width=True)
 
         st.markdown("""
         ---
@@ -502,21 +978,7 @@ def show_rules_page():
         st.subheader("Ejemplos de Estrategias de Supervivencia")
 
         # Gráfico de Barras para Estrategias
-        df_estrategias = pd.DataFrame({
-            'Estrategia': ['Solo Responder', 'Solo Crear', 'Mix Equilibrado'],
-            'Acciones Necesarias': [30, 15, 20], # 30 respuestas, 15 creadas, 10 creadas + 10 respondidas = 20 acciones
-            'Detalle': ['30 Respuestas', '15 Preguntas Creadas', '10 Creadas + 10 Respuestas']
-        })
-        
-        chart_estrategias = alt.Chart(df_estrategias).mark_bar().encode(
-            x=alt.X('Estrategia', sort=None, title=''),
-            y=alt.Y('Acciones Necesarias', title='Cantidad de Acciones para llegar a 30 Pts'),
-            color=alt.Color('Estrategia', legend=None),
-            tooltip=['Estrategia', 'Detalle']
-        ).properties(
-            title='Cómo Acumular 30 Puntos'
-        )
-        st.altair_chart(chart_estrategias, use_container_width=True)
+        st.altair_chart(_chart_estrategias(), use_container_width=True)
         st.caption("El gráfico muestra cuántas acciones de cada tipo necesitas para cumplir la cuota. Un 'Mix' es a menudo la estrategia más sostenible.")
 
     # --- Pestaña 3: Rangos y Medallas ---
@@ -545,80 +1007,61 @@ def show_rules_page():
         - **Votos Negativos (👎):** ¡Cuidado! Si una pregunta acumula 3 o más votos negativos, es marcada para revisión por un administrador. Abusar de preguntas de baja calidad puede afectar tu estatus.
         """)
 
-def check_rate_limit():
-    """Previene abuso por acciones demasiado rápidas (spam/scraping)."""
-    now = datetime.datetime.now()
-    last_action = st.session_state.get("last_action_time", None)
+def token_bucket_try(key, capacity=RATE_LIMIT_CAPACITY, rate=RATE_LIMIT_PER_SECOND):
+    """
+    Intenta consumir una ficha del bucket `key` (vive en la BD: vale para todas las pestañas
+    y procesos). La recarga se calcula en el mismo UPSERT. Devuelve True si había ficha.
+    """
+    conn = get_db_conn()
+    with conn:
+        row = conn.execute(SQL_TAKE_TOKEN, {"key": key, "cap": capacity, "rate": rate, "now": time.time()}).fetchone()
+    return row is not None
 
-    if last_action and (now - last_action).total_seconds() < 2:
+def check_rate_limit(key):
+    """Previene abuso por acciones demasiado rápidas (spam/scraping)."""
+    if not token_bucket_try(key):
         st.warning("⏳ Vas muy rápido. Tómate un respiro.")
         st.stop()
-    
-    # Actualiza el tiempo de la acción actual para la próxima verificación.
-    st.session_state.last_action_time = now
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def prune_rate_buckets(day):
+    """
+    Borra los buckets ya recargados del todo (usuarios inexistentes, purgados, IPs de paso).
+    Cacheada por día (YYYY-MM-DD): corre una vez por día y por proceso.
+    """
+    with closing(_open_db_conn()) as conn, conn:
+        conn.execute(SQL_PRUNE_BUCKETS, {"now": time.time(), "ttl": RATE_BUCKET_TTL})
+    return True
 
 
 def update_user_activity(conn, username):
     """
     Actualiza la racha y los días de actividad de un usuario de forma segura,
-    utilizando una conexión de BD existente.
+    utilizando una conexión de BD existente. Un solo UPDATE: si ya estudió hoy no toca
+    la fila; si estudió ayer la racha continúa, si no se reinicia a 1.
     """
-    # Aseguramos traer todas las columnas necesarias para la lógica
-    user = conn.execute("SELECT last_active_date, current_streak, total_active_days, last_streak_date FROM users WHERE username = ?", (username,)).fetchone()
-    
-    if not user:
-        return
-
-    today = datetime.date.today()
-    last_active_str = user['last_active_date']
-    
-    # Si el usuario ya estudió hoy, no hacemos nada.
-    if last_active_str == today.strftime('%Y-%m-%d'):
-        return
-        
-    current_streak = user['current_streak'] or 0
-    total_active_days = user['total_active_days'] or 0
-
-    if last_active_str is None:
-        # Primer día de actividad
-        new_streak = 1
-        new_total_days = 1
-    else:
-        last_active_date = datetime.datetime.strptime(last_active_str, '%Y-%m-%d').date()
-        yesterday = today - datetime.timedelta(days=1)
-        
-        if last_active_date == yesterday:
-            # La racha continúa
-            new_streak = current_streak + 1
-            new_total_days = total_active_days + 1
-        else:
-            # La racha se rompió
-            new_streak = 1
-            new_total_days = total_active_days + 1
-            
-    conn.execute(
-        "UPDATE users SET last_active_date = ?, current_streak = ?, total_active_days = ? WHERE username = ?",
-        (today, new_streak, new_total_days, username)
-    )
+    conn.execute(SQL_TOUCH_ACTIVITY, {"username": username, "today": datetime.date.today().isoformat()})
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _login_metrics():
+    """Conteos del dashboard de bienvenida. Cambian poco: se comparten entre sesiones por 60 s."""
+    with db_conn() as conn:
+        q_count = conn.execute("SELECT COUNT(*) FROM questions").fetchone()[0]
+        u_count = conn.execute("SELECT COUNT(*) FROM users WHERE role != 'admin' AND status = 'active'").fetchone()[0]
+        try:
+            del_count = conn.execute("SELECT COUNT(*) FROM deleted_users_log").fetchone()[0]
+        except sqlite3.OperationalError:
+            del_count = 0 # Fallback si la tabla no existe
+    return q_count, u_count, del_count
 
 def show_login_page():
     """Muestra un dashboard de bienvenida con métricas y gestiona el login/registro."""
     # --- 1. SECCIÓN MOTIVACIONAL Y MÉTRICAS ---
-    # Conexión solo para métricas
-    conn_metrics = get_db_conn()
     try:
-        q_count = conn_metrics.execute("SELECT COUNT(*) FROM questions").fetchone()[0]
-        u_count = conn_metrics.execute("SELECT COUNT(*) FROM users WHERE role != 'admin' AND status = 'active'").fetchone()[0]
-        try:
-            del_count = conn_metrics.execute("SELECT COUNT(*) FROM deleted_users_log").fetchone()[0]
-        except sqlite3.OperationalError:
-            del_count = 0 # Fallback si la tabla no existe
+        q_count, u_count, del_count = _login_metrics()
     except Exception as e:
         q_count, u_count, del_count = "N/A", "N/A", "N/A"
         print(f"DEBUG: Error cargando métricas del login: {e}")
-    finally:
-        if conn_metrics:
-            conn_metrics.close()
 
     # Frase Central
     st.markdown("""
@@ -649,44 +1092,55 @@ def show_login_page():
         login_submitted = st.form_submit_button("Ingresar")
 
         if login_submitted:
-            check_rate_limit()
             # Higiene de datos: eliminar espacios y forzar minúsculas
             clean_username = username.strip().lower()
+            # Por IP del cliente: probar nombres al azar no crea una fila por cada nombre
+            check_rate_limit(f"login:{getattr(st.context, 'ip_address', None) or clean_username}")
             conn = get_db_conn()
             
             # --- INICIO: Lógica Anti-Fuerza Bruta ---
-            user = conn.execute("SELECT * FROM users WHERE username = ?", (clean_username,)).fetchone()
+            # Una sola lectura: fila del usuario + su última actividad (índice idx_activity_user_time)
+            user = conn.execute(SQL_LOGIN_USER, (clean_username,)).fetchone()
+            # Un solo instante de referencia para todas las comprobaciones de este intento
+            now = datetime.datetime.now()
+            today = now.date()
 
             if not user:
                 st.error("Usuario o contraseña incorrectos.")
-                if conn: conn.close()
                 return
 
             # 1. Chequeo de Bloqueo
             if user['lockout_until']:
                 try:
                     lockout_time = datetime.datetime.fromisoformat(user['lockout_until'])
-                    if lockout_time > datetime.datetime.now():
-                        remaining_time = lockout_time - datetime.datetime.now()
+                    if lockout_time > now:
+                        remaining_time = lockout_time - now
                         minutes = math.ceil(remaining_time.total_seconds() / 60)
                         st.error(f"Cuenta bloqueada temporalmente. Intenta de nuevo en {minutes} minutos.")
-                        if conn: conn.close()
                         return
                 except (ValueError, TypeError):
                     # Ignorar si el formato de fecha es inválido y proceder
                     pass
 
             # 2. Verificación de Contraseña
+            # Antes de argon2 (caro a propósito): máx. 5 verificaciones por usuario+IP cada 15 min
+            # Sin IP conocida (p. ej. detrás de un proxy que no la expone) el límite queda
+            # solo por usuario, de forma explícita: es el mismo tope que ya impone lockout_until
+            client_ip = getattr(st.context, "ip_address", None)
+            pwd_key = f"pwd:{clean_username}|{client_ip}" if client_ip else f"pwd:{clean_username}"
+            if not token_bucket_try(pwd_key, capacity=LOGIN_VERIFY_CAPACITY, rate=LOGIN_VERIFY_PER_SECOND):
+                st.error("Demasiados intentos de inicio de sesión. Espera unos minutos antes de volver a intentarlo.")
+                return
+
             if verify_password(password, user['password_hash']):
                 # ACIERTO: Resetear contadores y proceder al login
                 if user['failed_attempts'] > 0 or user['lockout_until'] is not None:
-                    conn.execute("UPDATE users SET failed_attempts = 0, lockout_until = NULL WHERE username = ?", (clean_username,))
-                    conn.commit()
+                    with conn:
+                        conn.execute("UPDATE users SET failed_attempts = 0, lockout_until = NULL WHERE username = ?", (clean_username,))
                 
                 # --- Lógica de login existente ---
                 if user['status'] == 'pending_delete':
                     st.error("Cuenta bloqueada por incumplimiento. Contacta al administrador.")
-                    conn.close()
                     return
 
                 if user['is_intensive']:
@@ -694,32 +1148,29 @@ def show_login_page():
                     start_date_str = user['intensive_start_date']
 
                     if start_date_str is None:
-                        today = datetime.date.today()
-                        conn.execute("UPDATE users SET intensive_start_date = ? WHERE username = ?", (today, clean_username))
-                        conn.commit()
+                        with conn:
+                            conn.execute("UPDATE users SET intensive_start_date = ? WHERE username = ?", (today, clean_username))
                         st.success(f"🛡️ Periodo de Gracia activado. Tienes {user['max_inactivity_days']} días para cumplir tu cuota.")
                         is_in_grace_period = True
                     else:
-                        start_date = datetime.datetime.strptime(start_date_str, '%Y-%m-%d').date()
-                        days_active = (datetime.date.today() - start_date).days
+                        start_date = parse_intensive_start(start_date_str).date()
+                        days_active = (today - start_date).days
                         if days_active < user['max_inactivity_days']:
                             is_in_grace_period = True
 
                     if not is_in_grace_period:
-                        score, _, _ = calculate_user_score(clean_username, user['max_inactivity_days'])
-                        last_activity_row = conn.execute("SELECT MAX(timestamp) as last_ts FROM activity_log WHERE username = ?", (clean_username,)).fetchone()
+                        score, _, _ = calculate_user_score(clean_username, user['max_inactivity_days'], conn=conn, user=user)
                         is_inactive = False
-                        if last_activity_row and last_activity_row['last_ts']:
-                            last_activity_date = datetime.datetime.fromisoformat(last_activity_row['last_ts'])
-                            if (datetime.datetime.now() - last_activity_date).days > user['max_inactivity_days']:
+                        if user['last_ts']:
+                            last_activity_date = datetime.datetime.fromisoformat(user['last_ts'])
+                            if (now - last_activity_date).days > user['max_inactivity_days']:
                                 is_inactive = True
                         else:
                             is_inactive = True
                         if score < 30 or is_inactive:
-                            conn.execute("UPDATE users SET status = 'pending_delete' WHERE username = ?", (clean_username,))
-                            conn.commit()
+                            with conn:
+                                conn.execute("UPDATE users SET status = 'pending_delete' WHERE username = ?", (clean_username,))
                             st.error("Cuenta bloqueada por incumplimiento del Modo Intensivo. Contacta al administrador.")
-                            conn.close()
                             return
                 
                 if user['is_approved'] == 1:
@@ -727,25 +1178,24 @@ def show_login_page():
                     st.session_state.current_user = user['username']
                     st.session_state.user_role = user['role']
                     st.session_state.current_page = "evaluacion"
-                    conn.close()
                     st.rerun()
                 else:
                     st.error("Tu cuenta está registrada, pero aún no ha sido aprobada por un administrador.")
             else:
-                # FALLO: Incrementar contador y potencialmente bloquear
+                # FALLO: Incrementar contador y potencialmente bloquear (un solo UPDATE)
                 new_attempts = user['failed_attempts'] + 1
                 if new_attempts >= 5:
-                    lockout_time = datetime.datetime.now() + datetime.timedelta(minutes=15)
-                    conn.execute("UPDATE users SET failed_attempts = 0, lockout_until = ? WHERE username = ?", (lockout_time.isoformat(), clean_username))
+                    new_attempts, lockout_iso = 0, (now + datetime.timedelta(minutes=15)).isoformat()
                     st.error("Contraseña incorrecta. Has superado el límite de intentos. Cuenta bloqueada por 15 minutos.")
                 else:
-                    conn.execute("UPDATE users SET failed_attempts = ? WHERE username = ?", (new_attempts, clean_username))
+                    lockout_iso = user['lockout_until']  # Se conserva (si existía ya está vencido)
                     st.error(f"Usuario o contraseña incorrectos. Intento {new_attempts} de 5.")
-                
-                conn.commit()
-            
-            if conn:
-                conn.close()
+
+                with conn:
+                    conn.execute(
+                        "UPDATE users SET failed_attempts = ?, lockout_until = ? WHERE username = ?",
+                        (new_attempts, lockout_iso, clean_username)
+                    )
 
     # --- 3. REGISTRO (ENCAPSULADO) ---
     st.markdown("<br>", unsafe_allow_html=True)
@@ -765,16 +1215,16 @@ def show_login_page():
                      st.error("Nombre de usuario no disponible.")
                 else:
                     try:
-                        password_new_bytes = new_password.encode('utf-8')[:72]
-                        hashed_pass = pwd_context.hash(password_new_bytes)
+                        hash_future = HASH_EXECUTOR.submit(pwd_context.hash, new_password)
+                        with st.spinner("Registrando usuario..."):
+                            hashed_pass = hash_future.result()
                         conn = get_db_conn()
-                        cursor = conn.cursor()
-                        cursor.execute(
-                            "INSERT INTO users (username, password_hash, role) VALUES (?, ?, 'user')",
-                            (clean_new_username, hashed_pass)
-                        )
-                        conn.commit()
-                        conn.close()
+                        with conn:
+                            conn.execute(
+                                "INSERT INTO users (username, password_hash, role) VALUES (?, ?, 'user')",
+                                (clean_new_username, hashed_pass)
+                            )
+                        load_user_list.clear()
                         st.success("¡Usuario registrado! Tu cuenta está pendiente de aprobación por un administrador.")
                     except sqlite3.IntegrityError:
                         st.error("Ese nombre de usuario ya existe.")
@@ -785,12 +1235,6 @@ def show_create_page():
     """Muestra el formulario para crear nuevas preguntas (con etiquetas)."""
     st.subheader("🖊️ Crear Nueva Pregunta")
     
-    CATEGORIAS_MEDICAS = [
-        "Medicina Interna", "Cirugía General", "Ortopedia", "Urología", 
-        "ORL", "Urgencia", "Psiquiatría", "Neurología", "Neurocirugía", 
-        "Epidemiología", "Pediatría", "Ginecología", "Oftalmología", "Otra"
-    ]
-    
     with st.form("create_question_form", clear_on_submit=True):
         enunciado = st.text_area("Enunciado de la pregunta")
         opciones = []
@@ -809,36 +1253,47 @@ def show_create_page():
         submitted = st.form_submit_button("Guardar Pregunta")
         
         if submitted:
-            check_rate_limit()
+            check_rate_limit(f"action:{st.session_state.current_user}")
             if not all([enunciado, opciones[0], opciones[1], opciones[2], opciones[3], retroalimentacion, tag_categoria, tag_tema]):
                 st.warning("Por favor, completa todos los campos.")
             else:
                 conn = get_db_conn()
-                cursor = conn.cursor()
                 opciones_str = "|".join(opciones) 
                 correcta = opciones[correcta_idx]
                 owner = st.session_state.current_user
                 
-                cursor.execute(
-                    "INSERT INTO questions (owner_username, enunciado, opciones, correcta, retroalimentacion, tag_categoria, tag_tema) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (owner, enunciado, opciones_str, correcta, retroalimentacion, tag_categoria, tag_tema)
-                )
+                with conn:
+                    conn.execute(
+                        "INSERT INTO questions (owner_username, enunciado, opciones, correcta, retroalimentacion, tag_categoria, tag_tema) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (owner, enunciado, opciones_str, correcta, retroalimentacion, tag_categoria, tag_tema)
+                    )
 
-                # --- INICIO SECCIÓN MODO INTENSIVO: Registrar actividad ---
-                cursor.execute(
-                    "INSERT INTO activity_log (username, action_type, timestamp) VALUES (?, 'create', ?)",
-                    (owner, datetime.datetime.now())
-                )
-                # --- FIN SECCIÓN MODO INTENSIVO ---
-                
-                # --- INICIO ACTUALIZACIÓN DE RACHA ---
-                update_user_activity(conn, owner)
-                # --- FIN ACTUALIZACIÓN DE RACHA ---
+                    # --- INICIO SECCIÓN MODO INTENSIVO: Registrar actividad ---
+                    conn.execute(
+                        "INSERT INTO activity_log (username, action_type, timestamp) VALUES (?, 'create', ?)",
+                        (owner, datetime.datetime.now())
+                    )
+                    # --- FIN SECCIÓN MODO INTENSIVO ---
+                    
+                    # --- INICIO ACTUALIZACIÓN DE RACHA ---
+                    update_user_activity(conn, owner)
+                    # --- FIN ACTUALIZACIÓN DE RACHA ---
 
-                conn.commit()
-                conn.close()
+                load_topic_counts.clear()
                 st.success("¡Pregunta guardada con éxito!")
 
+def pick_random_question(cursor, where, params=()):
+    """
+    Pregunta al azar que cumple `where`, sin ORDER BY RANDOM() (que ordena todas las
+    candidatas): cuenta por índice y salta a un desplazamiento aleatorio.
+    """
+    total = cursor.execute(f"SELECT COUNT(*) FROM questions WHERE {where}", params).fetchone()[0]
+    if not total:
+        return None
+    return cursor.execute(
+        f"SELECT id FROM questions WHERE {where} LIMIT 1 OFFSET ?", (*params, random.randrange(total))
+    ).fetchone()
+
 def get_next_question_for_user(username, practice_mode=False): # practice_mode es ahora ignorado
     """
     Obtiene la próxima pregunta para el usuario, fusionando Evaluación y Práctica en un Flujo Infinito.
@@ -857,12 +1312,7 @@ def get_next_question_for_user(username, practice_mode=False): # practice_mode e
     # Se mantiene esta funcionalidad ya que es una selección explícita del usuario
     if st.session_state.get('practice_mode') and st.session_state.get('selected_tag'):
         tag = st.session_state.selected_tag
-        cursor.execute(
-            "SELECT id FROM questions WHERE tag_tema = ? AND status = 'active' ORDER BY RANDOM() LIMIT 1",
-            (tag,)
-        )
-        practice_question = cursor.fetchone()
-        conn.close()
+        practice_question = pick_random_question(cursor, "tag_tema = ? AND status = 'active'", (tag,))
         if not practice_question:
             return None
         # Se retorna con la nueva estructura, asumiendo que no es un adelanto.
@@ -886,7 +1336,6 @@ def get_next_question_for_user(username, practice_mode=False): # practice_mode e
     cursor.execute(query_priority, (username, today, today))
     question = cursor.fetchone()
     if question:
-        conn.close()
         return {'id': question['id'], 'is_advance': False}
 
     # Intento 2: Adelantos Inteligentes (preguntas futuras)
@@ -896,22 +1345,18 @@ def get_next_question_for_user(username, practice_mode=False): # practice_mode e
         JOIN progress p ON q.id = p.question_id
         WHERE
             p.username = ? AND q.status = 'active' AND p.due_date > ?
-            AND (p.last_review IS NULL OR p.last_review != ?)
+            AND (p.last_review IS NULL OR p.last_review < ?) -- last_review nunca es futuro: "!= hoy" equivale a "< hoy"
         ORDER BY p.due_date ASC -- Las que vencen más pronto primero
         LIMIT 1
     """
     cursor.execute(query_advance, (username, today, today))
     question = cursor.fetchone()
     if question:
-        conn.close()
         return {'id': question['id'], 'is_advance': True}
 
     # Intento 3: Respaldo Final (Cualquier pregunta activa)
     # Solo se llega aquí si no hay vencidas, ni nuevas, ni futuras (ej. todo se repasó hoy).
-    query_fallback = "SELECT id FROM questions WHERE status = 'active' ORDER BY RANDOM() LIMIT 1"
-    cursor.execute(query_fallback)
-    question = cursor.fetchone()
-    conn.close()
+    question = pick_random_question(cursor, "status = 'active'")
     
     if question:
         # Se considera un adelanto forzado, ya que no estaba en la cola prioritaria.
@@ -920,12 +1365,28 @@ def get_next_question_for_user(username, practice_mode=False): # practice_mode e
     # Si no hay absolutamente ninguna pregunta activa en el sistema.
     return None
 
+@functools.lru_cache(maxsize=4096)
+def fsrs_difficulty_step(grade, d_prev):
+    """
+    Nueva dificultad D (acotada a 1.0-10.0) y factor de crecimiento de la estabilidad.
+    Función pura de (grade, d_prev): D solo toma valores de una malla pequeña
+    (5.0 ± pasos fijos por grado), así que casi siempre se resuelve desde la caché.
+    """
+    if d_prev == 0.0:
+        d_new = 5.0  # Valor inicial si es la primera vez
+    else:
+        # El 'costo' en la fórmula se deriva del 'grade'
+        d_new = d_prev - 0.32 + (0.18 * (grade - 3.0))
+
+    d_new = max(1.0, min(10.0, d_new))  # Se asegura que D esté entre 1.0 y 10.0
+    return d_new, 1 + (1.5 / (d_new * 0.3))
+
 def update_srs(conn, username, question_id, difficulty_rating):
     """
     Actualiza el SRS en la BD usando la lógica FSRS v4 simplificada y registra la actividad.
     Rating mapping: 'difícil'->1 (Olvido), 'medio'->3 (Costoso), 'fácil'->5 (Bien).
+    El llamador la ejecuta dentro de `with conn:` (UPSERT y log en la misma transacción).
     """
-    cursor = conn.cursor()
     today = datetime.date.today()
 
     # 1. Mapeo del rating de entrada a un grado numérico
@@ -936,24 +1397,14 @@ def update_srs(conn, username, question_id, difficulty_rating):
     else: # "fácil"
         grade = 5
     
-    # 2. Obtener el estado SRS actual de la pregunta para el usuario
-    cursor.execute(
-        "SELECT stability, difficulty FROM progress WHERE username = ? AND question_id = ?",
-        (username, question_id)
-    )
-    progress = cursor.fetchone()
+    # 2. Obtener el estado SRS actual de la pregunta para el usuario (y sus contadores)
+    progress = conn.execute(SQL_SRS_STATE, (username, question_id)).fetchone()
 
     s_prev = progress['stability'] if progress and progress['stability'] is not None else 0.0
     d_prev = progress['difficulty'] if progress and progress['difficulty'] is not None else 0.0
 
-    # 3. Cálculo de Dificultad (D)
-    if d_prev == 0.0:
-        d_new = 5.0  # Valor inicial si es la primera vez
-    else:
-        # El 'costo' en la fórmula se deriva del 'grade'
-        d_new = d_prev - 0.32 + (0.18 * (grade - 3.0))
-    
-    d_new = max(1.0, min(10.0, d_new))  # Se asegura que D esté entre 1.0 y 10.0
+    # 3. Cálculo de Dificultad (D) y del factor de crecimiento de S
+    d_new, factor_crecimiento = fsrs_difficulty_step(grade, d_prev)
 
     # 4. Cálculo de Estabilidad (S)
     if s_prev == 0.0:  # Si la tarjeta es nueva
@@ -964,7 +1415,6 @@ def update_srs(conn, username, question_id, difficulty_rating):
         if grade == 1:  # Olvido
             s_new = s_prev * 0.4  # Penalización a la estabilidad
         else:  # Recordado (Medio o Fácil)
-            factor_crecimiento = 1 + (1.5 / (d_new * 0.3))
             s_new = s_prev * factor_crecimiento
 
     # 5. Cálculo del nuevo Intervalo (I)
@@ -975,10 +1425,8 @@ def update_srs(conn, username, question_id, difficulty_rating):
     new_due_date = today + datetime.timedelta(days=int(new_interval))
 
     # 7. Actualización de contadores de aciertos/fallos (lógica heredada)
-    cursor.execute("SELECT aciertos, fallos FROM progress WHERE username = ? AND question_id = ?", (username, question_id))
-    aciertos_fallos = cursor.fetchone()
-    aciertos = aciertos_fallos['aciertos'] if aciertos_fallos else 0
-    fallos = aciertos_fallos['fallos'] if aciertos_fallos else 0
+    aciertos = progress['aciertos'] if progress else 0
+    fallos = progress['fallos'] if progress else 0
     
     if grade == 1:
         fallos += 1
@@ -986,24 +1434,10 @@ def update_srs(conn, username, question_id, difficulty_rating):
         aciertos += 1
 
     # 8. Actualizar la base de datos con todos los nuevos valores (UPSERT)
-    cursor.execute("""
-        INSERT INTO progress (username, question_id, due_date, interval, aciertos, fallos, stability, difficulty, last_review)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(username, question_id) DO UPDATE SET
-            due_date = excluded.due_date,
-            interval = excluded.interval,
-            aciertos = excluded.aciertos,
-            fallos = excluded.fallos,
-            stability = excluded.stability,
-            difficulty = excluded.difficulty,
-            last_review = excluded.last_review
-    """, (username, question_id, new_due_date, new_interval, aciertos, fallos, s_new, d_new, today))
+    conn.execute(SQL_SRS_UPSERT, (username, question_id, new_due_date, new_interval, aciertos, fallos, s_new, d_new, today))
     
     # --- Registrar actividad para Modo Intensivo y Rachas ---
-    cursor.execute(
-        "INSERT INTO activity_log (username, action_type, timestamp) VALUES (?, 'answer', ?)",
-        (username, datetime.datetime.now())
-    )
+    conn.execute(SQL_LOG_ANSWER, (username, datetime.datetime.now()))
     update_user_activity(conn, username)
 
 def reset_evaluation_state():
@@ -1016,6 +1450,24 @@ def reset_evaluation_state():
     if 'previous_is_advance' in st.session_state:
         del st.session_state['previous_is_advance']
 
+# Prefijos de las claves de session_state que describen el estado de una tarjeta
+CARD_STATE_PREFIXES = ("card_state_", "user_answer_", "feedback_shown_")
+
+def purge_card_state(question_id):
+    """Borra el estado guardado de una tarjeta (pop: sin comprobar antes si existe)."""
+    for prefix in CARD_STATE_PREFIXES:
+        st.session_state.pop(f"{prefix}{question_id}", None)
+
+@st.cache_data(ttl=600, show_spinner=False)
+def load_question(question_id):
+    """
+    Fila de una pregunta como dict (o None). Cacheada: la tarjeta se re-renderiza en
+    cada interacción y la pregunta casi nunca cambia. Editar, borrar o votar la invalida.
+    """
+    with db_conn() as conn:
+        row = conn.execute(SQL_QUESTION_BY_ID, (question_id,)).fetchone()
+    return dict(row) if row else None
+
 def render_question_card(question_id):
     # --- SENSOR DE INICIO (CRONÓMETRO) ---
     # Usamos el ID de la pregunta para crear un timer único
@@ -1032,15 +1484,7 @@ def render_question_card(question_id):
     # Debemos reiniciarlo obligatoriamente para que el usuario pueda responder.
     if current_state == 'done':
         # Borramos variables clave para forzar un reinicio limpio
-        keys_to_purge = [
-            key_state,
-            f"user_answer_{question_id}",
-            f"feedback_shown_{question_id}",
-            f"shuffled_options_{question_id}"
-        ]
-        for k in keys_to_purge:
-            if k in st.session_state:
-                del st.session_state[k]
+        purge_card_state(question_id)
         
         # Forzamos el estado inicial
         st.session_state[key_state] = "showing_question"
@@ -1054,16 +1498,14 @@ def render_question_card(question_id):
     if card_state_key not in st.session_state:
         st.session_state[card_state_key] = "showing_question"
 
+    # Conexión de la sesión, compartida por los handlers de karma y SRS de la tarjeta
     conn = get_db_conn()
-    pregunta_row = conn.execute("SELECT * FROM questions WHERE id = ?", (question_id,)).fetchone()
-    conn.close()
+    pregunta = load_question(question_id)
     
-    if not pregunta_row:
+    if not pregunta:
         st.error("Error: La pregunta no se encontró en la base de datos.")
         return True # Solicitar pasar a la siguiente para evitar un bucle
 
-    pregunta = dict(pregunta_row)
-
     # --- BLINDAJE CONTRA DATOS CORRUPTOS ---
     try:
         # Asegurarse de que el campo 'opciones' no es None, no está vacío y contiene el separador.
@@ -1093,14 +1535,11 @@ def render_question_card(question_id):
             correct_option_with_prefix = original_options_with_prefix[i]
             break
 
-    # 2. Mezcla (Shuffle) Persistente
-    shuffle_key = f"shuffled_options_{question_id}"
-    if shuffle_key in st.session_state:
-        display_options = st.session_state[shuffle_key]
-    else:
-        display_options = original_options_with_prefix.copy()
-        random.shuffle(display_options)
-        st.session_state[shuffle_key] = display_options
+    # 2. Mezcla (Shuffle) Estable sin guardar la lista en session_state: la semilla es
+    # usuario + pregunta + inicio del cronómetro, así el orden se mantiene en cada rerun
+    # de esta tarjeta y cambia en la siguiente visita (el cronómetro se reinicia)
+    display_options = original_options_with_prefix.copy()
+    random.Random(f"{st.session_state.current_user}:{question_id}:{st.session_state[start_key]}").shuffle(display_options)
     # -------------------------------------
 
     # --- 2. Lógica de Renderizado y Estado ---
@@ -1148,13 +1587,9 @@ def render_question_card(question_id):
                 k_col1, k_col2 = st.columns(2)
                 
                 def handle_karma_update(vote_type):
-                    conn = None
-                    try:
-                        conn = get_db_conn()
+                    with conn:
                         update_karma(conn, st.session_state.current_user, question_id, vote_type)
-                        conn.commit()
-                    finally:
-                        if conn: conn.close()
+                    load_question.clear(question_id)
                     st.rerun()
 
                 if k_col1.button(f"👍 {pregunta['karma']}", key=f"karma_up_{question_id}"):
@@ -1168,7 +1603,7 @@ def render_question_card(question_id):
             srs_cols = st.columns(3)
             
             def handle_srs_update(difficulty):
-                check_rate_limit()
+                check_rate_limit(f"action:{st.session_state.current_user}")
                 # --- LOG DE ÉXITO Y SRS ---
                 start_time = st.session_state.get(f"timer_start_{question_id}")
                 duration = (datetime.datetime.now() - start_time).total_seconds() if start_time else 0
@@ -1188,13 +1623,8 @@ def render_question_card(question_id):
                 
                 # --- FIN DEL BLOQUE DE LOGGING ---
 
-                conn = None
-                try:
-                    conn = get_db_conn()
+                with conn:
                     update_srs(conn, st.session_state.current_user, question_id, difficulty)
-                    conn.commit()
-                finally:
-                    if conn: conn.close()
                 st.session_state[card_state_key] = "done"
                 
             if srs_cols[0].button("Difícil", key=f"srs_hard_{question_id}"):
@@ -1258,14 +1688,12 @@ def show_evaluation_page():
         del st.session_state.current_eval_question_data
         st.rerun()
 
-def show_topics_page():
+@st.cache_data(ttl=60, show_spinner=False)
+def load_topic_counts():
     """
-    Página de la Biblioteca por Temas. Permite al usuario elegir una CATEGORÍA
-    y luego le presenta preguntas de esa categoría una por una.
+    Categorías con preguntas activas y su conteo, como tupla inmutable de (tag, total). Cambia poco:
+    se cachea y se invalida al crear/editar/borrar.
     """
-    st.header("📚 Biblioteca por Categorías")
-
-    conn = get_db_conn()
     # CORRECCIÓN: Se consulta tag_categoria, que tiene los datos limpios.
     query = """
         SELECT tag_categoria as tag, COUNT(*) as total 
@@ -1274,27 +1702,32 @@ def show_topics_page():
         GROUP BY tag_categoria 
         ORDER BY tag_categoria ASC
     """
+    with db_conn() as conn:
+        # CORRECCIÓN: Filtro de basura para eliminar etiquetas cortas/inválidas.
+        return tuple((row['tag'], row['total']) for row in conn.execute(query) if len(row['tag']) >= 3)
+
+def show_topics_page():
+    """
+    Página de la Biblioteca por Temas. Permite al usuario elegir una CATEGORÍA
+    y luego le presenta preguntas de esa categoría una por una.
+    """
+    st.header("📚 Biblioteca por Categorías")
+
     try:
-        topics_df = pd.read_sql_query(query, conn)
+        topic_rows = load_topic_counts()
     except Exception as e:
         st.error(f"Error al consultar las categorías: {e}")
         return
-    finally:
-        conn.close()
-
-    # CORRECCIÓN: Filtro de basura para eliminar etiquetas cortas/inválidas.
-    if not topics_df.empty:
-        topics_df = topics_df[topics_df['tag'].str.len() >= 3]
 
-    if topics_df.empty:
+    if not topic_rows:
         st.info("No hay categorías con preguntas activas para mostrar. ¡Crea algunas preguntas con etiquetas!")
         return
 
     # --- 1. VISTA DE SELECCIÓN DE CATEGORÍA ---
     
     # Crear un diccionario para el mapeo de formato fácil
-    tag_counts = pd.Series(topics_df.total.values, index=topics_df.tag).to_dict()
-    topic_list = topics_df['tag'].tolist()
+    tag_counts = dict(topic_rows)
+    topic_list = tuple(tag for tag, _ in topic_rows)
 
     if 'selected_topic' not in st.session_state:
         st.session_state.selected_topic = None
@@ -1335,11 +1768,7 @@ def show_topics_page():
         if 'topic_question_id' not in st.session_state:
             conn = get_db_conn()
             # CORRECCIÓN: Se busca por tag_categoria en la práctica.
-            question_row = conn.execute(
-                "SELECT id FROM questions WHERE tag_categoria = ? AND status = 'active' ORDER BY RANDOM() LIMIT 1",
-                (selected_tag,)
-            ).fetchone()
-            conn.close()
+            question_row = pick_random_question(conn, "tag_categoria = ? AND status = 'active'", (selected_tag,))
             st.session_state.topic_question_id = question_row['id'] if question_row else None
 
         q_id = st.session_state.topic_question_id
@@ -1355,14 +1784,13 @@ def show_topics_page():
             del st.session_state.topic_question_id
             st.rerun()
 
-def show_stats_page():
-    """Muestra un dashboard analítico con un sistema de clasificación automática."""
-    st.header("📊 Dashboard Analítico de la Comunidad")
-    
-    conn = get_db_conn()
-
-    # Bloque de extracción de datos para el gráfico de Radar.
-    # Se ejecuta una consulta para obtener el rendimiento por tema del usuario.
+@st.cache_data(ttl=60, show_spinner=False)
+def load_radar_data(username):
+    """
+    Rendimiento por tema del usuario para el Radar Clínico (top 6 categorías).
+    Cacheado por usuario: los reruns de la página no repiten la consulta.
+    """
+    import pandas as pd
     sql_radar = """
         SELECT
             q.tag_categoria AS tag,
@@ -1379,31 +1807,17 @@ def show_stats_page():
         ORDER BY total_preguntas DESC
         LIMIT 6
     """
-    df_radar = pd.read_sql_query(sql_radar, conn, params=(st.session_state.current_user,))
+    with db_conn() as conn:
+        return pd.read_sql_query(sql_radar, conn, params=(username,))
 
-    if not df_radar.empty:
-        df_radar['Puntaje'] = (df_radar['preguntas_dominadas'] / df_radar['total_preguntas']) * 100
-
-    if not df_radar.empty:
-        st.subheader("🎯 Tu Radar Clínico")
-        # Crear el gráfico
-        fig = px.line_polar(
-            df_radar,
-            r='Puntaje',
-            theta='tag',
-            line_close=True,
-            range_r=[0, 100],  # Escala fija de 0 a 100%
-        )
-        fig.update_traces(fill='toself') # Relleno de color sólido
-        # Mostrar en Streamlit
-        st.plotly_chart(fig, use_container_width=True)
-    else:
-        st.info("Responde preguntas de diferentes temas para activar tu Radar Clínico.")
-    
-    # 1. Extracción de Datos Granulares
-    total_questions_global = conn.execute("SELECT COUNT(*) as count FROM questions WHERE status = 'active'").fetchone()['count']
-    
-    # Query para obtener todos los datos base de usuarios y su progreso
+@st.cache_data(ttl=60, show_spinner=False)
+def load_ranking_data():
+    """
+    Datos base del ranking (todos los usuarios activos) y total de preguntas activas.
+    Es igual para todos los usuarios, así que una sola entrada de cache sirve a todos.
+    """
+    import pandas as pd
+    # Datos base de usuarios + agregados de progreso ya materializados en user_stats
     query = """
         SELECT 
             u.username,
@@ -1411,32 +1825,96 @@ def show_stats_page():
             u.is_reference_model,
             u.total_active_days,
             u.current_streak,
-            COALESCE(SUM(p.aciertos), 0) as total_aciertos,
-            COALESCE(SUM(p.fallos), 0) as total_fallos,
-            COALESCE(SUM(CASE WHEN p.interval > 7 THEN 1 ELSE 0 END), 0) as mastered_count
+            COALESCE(s.total_aciertos, 0) as total_aciertos,
+            COALESCE(s.total_fallos, 0) as total_fallos,
+            COALESCE(s.mastered_count, 0) as mastered_count
         FROM 
             users u
         LEFT JOIN 
-            progress p ON u.username = p.username
+            user_stats s ON u.username = s.username
         WHERE
             u.role != 'admin' AND u.status = 'active'
-        GROUP BY
-            u.username, u.is_resident, u.is_reference_model
     """
-    df = pd.read_sql_query(query, conn)
-    
-    if df.empty:
-        st.info("No hay datos de progreso de usuarios para mostrar en el ranking.")
-        conn.close()
-        return
+    with db_conn() as conn:
+        total_questions_global = conn.execute("SELECT COUNT(*) as count FROM questions WHERE status = 'active'").fetchone()['count']
+        return pd.read_sql_query(query, conn), total_questions_global
+
+@st.cache_resource(max_entries=256, show_spinner=False)
+def _radar_figure(tags, puntajes):
+    """Radar Clínico para unos datos dados. Se reutiliza entre reruns mientras los datos no cambien."""
+    import pandas as pd
+    fig = px.line_polar(
+        pd.DataFrame({'tag': tags, 'Puntaje': puntajes}),
+        r='Puntaje',
+        theta='tag',
+        line_close=True,
+        range_r=[0, 100],  # Escala fija de 0 a 100%
+    )
+    fig.update_traces(fill='toself') # Relleno de color sólido
+    return fig
 
-    # 2. Transformación y Cálculo de Métricas
-    df['total_answers'] = df['total_aciertos'] + df['total_fallos']
-    df['accuracy'] = (df['total_aciertos'] / df['total_answers'] * 100).fillna(0.0)
-    df['mastery'] = (df['mastered_count'] / total_questions_global * 100) if total_questions_global > 0 else 0.0
+@st.cache_resource(max_entries=256, show_spinner=False)
+def _comparison_chart(val_tu, val_comunidad, val_top10):
+    """Gráfico 'Tú vs. Comunidad vs. Top 10'. Se reutiliza entre reruns mientras los valores no cambien."""
+    import pandas as pd
+    # 2. Preparación del DataFrame para el gráfico
+    data_comp = pd.DataFrame({
+        'Comparativa': ['Tú', 'Promedio Comunidad', 'Top 10 Expertos'],
+        'Precisión': [val_tu, val_comunidad, val_top10],
+        'Color': ['#3b82f6', '#9ca3af', '#eab308']  # Azul Vivo, Gris Neutro, Dorado Brillante
+    })
 
-    # --- CALCULAR PROMEDIO DE RESIDENTES ---
-    # Filtrar usuarios que son residentes (is_resident == 1)
+    # 3. Visualización (Altair) - Barras + Texto
+    bars = alt.Chart(data_comp).mark_bar().encode(
+        x=alt.X('Comparativa:N', sort=None, title=None, axis=alt.Axis(labelAngle=0)),
+        y=alt.Y('Precisión:Q', title='Precisión (%)', axis=alt.Axis(grid=False)),
+        color=alt.Color('Color:N', scale=None, legend=None),
+        tooltip=['Comparativa', alt.Tooltip('Precisión', title='Precisión', format='.1f')]
+    )
+
+    text = bars.mark_text(
+        align='center',
+        baseline='bottom',
+        dy=-10  # Mueve el texto 10px por encima de la barra
+    ).encode(
+        text=alt.Text('Precisión:Q', format='.1f')
+    )
+
+    return (bars + text).configure_view(strokeWidth=0)
+
+def show_stats_page():
+    """Muestra un dashboard analítico con un sistema de clasificación automática."""
+    import pandas as pd  # Import diferido: solo las páginas con tablas pagan su carga
+    st.header("📊 Dashboard Analítico de la Comunidad")
+    
+    df_radar = load_radar_data(st.session_state.current_user)
+
+    if not df_radar.empty:
+        df_radar['Puntaje'] = (df_radar['preguntas_dominadas'] / df_radar['total_preguntas']) * 100
+
+    if not df_radar.empty:
+        st.subheader("🎯 Tu Radar Clínico")
+        # Gráfico cacheado por sus datos (tags y puntajes)
+        fig = _radar_figure(tuple(df_radar['tag']), tuple(df_radar['Puntaje'].astype(float)))
+        # Mostrar en Streamlit
+        st.plotly_chart(fig, use_container_width=True)
+    else:
+        st.info("Responde preguntas de diferentes temas para activar tu Radar Clínico.")
+    
+    # 1. Extracción de Datos Granulares (cacheada, compartida por todos los usuarios)
+    df, total_questions_global = load_ranking_data()
+    
+    if df.empty:
+        st.info("No hay datos de progreso de usuarios para mostrar en el ranking.")
+        return
+
+    # 2. Transformación y Cálculo de Métricas
+    df['total_answers'] = df['total_aciertos'] + df['total_fallos']
+    df['accuracy'] = (df['total_aciertos'] / df['total_answers'] * 100).fillna(0.0)
+    df['mastery'] = (df['mastered_count'] / total_questions_global * 100) if total_questions_global > 0 else 0.0
+
+    # --- CALCULAR PROMEDIO DE RESIDENTES ---
+    # Filtrar usuarios que son residentes (is_resident == 1)
     resident_data = df[df['is_resident'] == 1]
     
     # Calcular promedio o usar valor por defecto si no hay residentes
@@ -1446,109 +1924,86 @@ def show_stats_page():
         avg_resident_accuracy = 85.0  # Valor base por defecto
     
     # Mostrar métrica en consola para depuración
-    print(f"📊 Promedio Precisión Residentes: {avg_resident_accuracy:.1f}%")
+    if DEBUG_STATS:
+        print(f"📊 Promedio Precisión Residentes: {avg_resident_accuracy:.1f}%")
 
     # 3. Algoritmo de Etiquetado (Clasificación)
-    def get_status_label(row, threshold):
-        """Asigna una etiqueta de rango al usuario basada en su rendimiento."""
-        # Jerarquía Absoluta: Si es el Fantasma/Modelo, es el Residente Supremo.
-        if row.get('is_reference_model') == 1:
-            return "🎓 Residente"
-        
-        if row['is_resident'] == 1:
-            return "🎓 Residente"
-            
-        # --- AQUI SIGUE LA LÓGICA EXISTENTE DE PRECISIÓN ---
-        if row['accuracy'] >= (threshold * 0.98) and row['total_answers'] > 50:
-            return "⭐ Experto"
-        if row['accuracy'] < 60.0 or (row['total_answers'] > 20 and row['mastery'] < 10.0):
-            return "🚑 En Riesgo"
-        return "🦁 Estudiante"
-
-    # Se pasa 'avg_resident_accuracy' como argumento a la función apply.
-    df['Estado'] = df.apply(get_status_label, axis=1, args=(avg_resident_accuracy,))
+    # Vectorizado: np.select toma la primera condición que se cumple, en orden de jerarquía.
+    # Jerarquía Absoluta: el Fantasma/Modelo y los residentes son "Residente".
+    is_residente = df['is_reference_model'].eq(1) | df['is_resident'].eq(1)
+    is_experto = df['accuracy'].ge(avg_resident_accuracy * 0.98) & df['total_answers'].gt(50)
+    is_en_riesgo = df['accuracy'].lt(60.0) | (df['total_answers'].gt(20) & df['mastery'].lt(10.0))
+    # Categórica ordenada por rango: 4 códigos enteros en vez de un string por usuario
+    df['Estado'] = pd.Categorical(
+        np.select(
+            [is_residente, is_experto, is_en_riesgo],
+            ["🎓 Residente", "⭐ Experto", "🚑 En Riesgo"],
+            default="🦁 Estudiante"
+        ),
+        categories=["🎓 Residente", "⭐ Experto", "🦁 Estudiante", "🚑 En Riesgo"],
+        ordered=True
+    )
 
     # --- INICIO: LÓGICA DE ORDENAMIENTO DEL RANKING ---
-    # 1. Ordenar: Constancia (Rey) -> Precisión -> Maestría
-    df = df.sort_values(by=['total_active_days', 'accuracy', 'mastery'], ascending=[False, False, False])
-    # 2. Resetear índice para que empiece en 0 el orden nuevo
-    df = df.reset_index(drop=True)
+    # 1-2. Ordenar: Constancia (Rey) -> Precisión -> Maestría, con índice nuevo desde 0
+    # en la misma pasada. Orden completo (no nlargest): la tabla muestra a todos con su posición.
+    df = df.sort_values(by=['total_active_days', 'accuracy', 'mastery'], ascending=[False, False, False], ignore_index=True)
     # 3. Crear columna de Posición (#) basada en el nuevo índice
     df.insert(0, '#', df.index + 1)
     # --- FIN: LÓGICA DE ORDENAMIENTO ---
 
     # Lógica de Racha para Display
-    df['dias_acumulados_display'] = df.apply(
-        lambda row: f"🔥 {row['total_active_days']}" if row['current_streak'] >= 3 else f"{row['total_active_days']}",
-        axis=1
-    )
+    dias_txt = df['total_active_days'].astype(str)
+    df['dias_acumulados_display'] = np.where(df['current_streak'] >= 3, "🔥 " + dias_txt, dias_txt)
 
     # --- INICIO: GRÁFICO COMPARATIVO DE RENDIMIENTO ---
     st.subheader("📈 Tu Rendimiento vs. La Comunidad")
 
-    # 1. Cálculo de Métricas con Pandas
+    # 1. Cálculo de Métricas
     # Nota: Se usa 'current_user' que es la variable correcta en st.session_state para esta app.
-    user_accuracy_row = df[df['username'] == st.session_state.current_user]
-    val_tu = user_accuracy_row['accuracy'].iloc[0] if not user_accuracy_row.empty else 0.0
-    
-    val_comunidad = df['accuracy'].mean()
-    # El df ya está ordenado, por lo que .head(10) obtiene los mejores usuarios.
-    val_top10 = df.head(10)['accuracy'].mean()
+    # Vista indexada por usuario (username es PK): búsquedas por hash en vez de comparar toda la columna
+    current_user = st.session_state.current_user
+    df_by_user = df.set_index('username', drop=False)
+    val_tu = df_by_user.at[current_user, 'accuracy'] if current_user in df_by_user.index else 0.0
+    # Una sola extracción a NumPy; el df ya está ordenado (constancia primero), así que
+    # sus 10 primeras filas son el Top 10 del ranking.
+    acc = df['accuracy'].to_numpy()
+    val_comunidad = acc.mean()
+    val_top10 = acc[:10].mean()
 
     # --- INICIO: BLOQUE DE DEBUG AUDITORÍA ---
-    print("\n" + "="*40)
-    print("🕵️‍♂️ AUDITORÍA DE DATOS DEL GRÁFICO")
-    print("="*40)
-    # 1. Verificar población total
-    print(f"👥 Total de Usuarios en DataFrame: {len(df)}")
-
-    # 2. Verificar datos de tu usuario
-    # Corregido a 'current_user' y formato de if/else
-    user_row_debug = df[df['username'] == st.session_state.current_user]
-    if not user_row_debug.empty:
-        tu_data = user_row_debug.iloc[0]
-        print(f"👤 TÚ ({tu_data['username']}): Constancia={tu_data['total_active_days']} días | Precisión={tu_data['accuracy']:.2f}%")
-    else:
-        print("👤 TÚ: No encontrado en el ranking.")
-
-    # 3. Verificar el Top 10 seleccionado
-    top_10_debug = df.head(10)
-    print("\n🏆 TOP 10 SELECCIONADOS (Orden actual):")
-    print(top_10_debug[['username', 'total_active_days', 'accuracy', 'mastery']].to_string(index=False))
-
-    # 4. Verificar los promedios matemáticos
-    prom_comunidad = df['accuracy'].mean()
-    prom_top10 = top_10_debug['accuracy'].mean()
-    print(f"\n🧮 CÁLCULOS INTERNOS:")
-    print(f"Promedio Comunidad: {prom_comunidad:.4f}%")
-    print(f"Promedio Top 10: {prom_top10:.4f}%")
-    print("="*40 + "\n")
+    # Solo con DEBUG_STATS=1: los print y el to_string se repetían en cada rerun
+    if DEBUG_STATS:
+        print("\n" + "="*40)
+        print("🕵️‍♂️ AUDITORÍA DE DATOS DEL GRÁFICO")
+        print("="*40)
+        # 1. Verificar población total
+        print(f"👥 Total de Usuarios en DataFrame: {len(df)}")
+
+        # 2. Verificar datos de tu usuario
+        # Corregido a 'current_user' y formato de if/else
+        if current_user in df_by_user.index:
+            tu_data = df_by_user.loc[current_user]
+            print(f"👤 TÚ ({tu_data['username']}): Constancia={tu_data['total_active_days']} días | Precisión={tu_data['accuracy']:.2f}%")
+        else:
+            print("👤 TÚ: No encontrado en el ranking.")
+
+        # 3. Verificar el Top 10 seleccionado
+        top_10_debug = df.head(10)
+        print("\n🏆 TOP 10 SELECCIONADOS (Orden actual):")
+        print(top_10_debug[['username', 'total_active_days', 'accuracy', 'mastery']].to_string(index=False))
+
+        # 4. Verificar los promedios matemáticos
+        prom_comunidad = df['accuracy'].mean()
+        prom_top10 = top_10_debug['accuracy'].mean()
+        print(f"\n🧮 CÁLCULOS INTERNOS:")
+        print(f"Promedio Comunidad: {prom_comunidad:.4f}%")
+        print(f"Promedio Top 10: {prom_top10:.4f}%")
+        print("="*40 + "\n")
     # --- FIN: BLOQUE DE DEBUG AUDITORÍA ---
     
-    # 2. Preparación del DataFrame para el gráfico
-    data_comp = pd.DataFrame({
-        'Comparativa': ['Tú', 'Promedio Comunidad', 'Top 10 Expertos'],
-        'Precisión': [val_tu, val_comunidad, val_top10],
-        'Color': ['#3b82f6', '#9ca3af', '#eab308']  # Azul Vivo, Gris Neutro, Dorado Brillante
-    })
-
-    # 3. Visualización (Altair) - Barras + Texto
-    bars = alt.Chart(data_comp).mark_bar().encode(
-        x=alt.X('Comparativa:N', sort=None, title=None, axis=alt.Axis(labelAngle=0)),
-        y=alt.Y('Precisión:Q', title='Precisión (%)', axis=alt.Axis(grid=False)),
-        color=alt.Color('Color:N', scale=None, legend=None),
-        tooltip=['Comparativa', alt.Tooltip('Precisión', title='Precisión', format='.1f')]
-    )
-
-    text = bars.mark_text(
-        align='center',
-        baseline='bottom',
-        dy=-10  # Mueve el texto 10px por encima de la barra
-    ).encode(
-        text=alt.Text('Precisión:Q', format='.1f')
-    )
-
-    chart = (bars + text).configure_view(strokeWidth=0)
+    # 2-3. Gráfico (Altair) cacheado por los tres valores
+    chart = _comparison_chart(float(val_tu), float(val_comunidad), float(val_top10))
 
     st.altair_chart(chart, use_container_width=True)
     st.markdown("---") # Separador visual antes de la tabla de ranking
@@ -1587,8 +2042,10 @@ def show_stats_page():
         column_order=("#", "Usuario", "Estado", "Días Acumulados", "Precisión", "Maestría", "Respuestas")
     )
 
-    conn.close()
 
+# Fragmento: el buscador y los botones de la lista solo re-ejecutan esta página (no el sidebar);
+# guardar o borrar sigue llamando a st.rerun() para refrescar toda la app
+@st.fragment
 def show_manage_questions_page():
     """Permite gestionar (Editar y Eliminar) preguntas con confirmación de borrado, agrupadas por categoría."""
     if 'editing_question_id' not in st.session_state:
@@ -1604,14 +2061,12 @@ def show_manage_questions_page():
         q_id = st.session_state.editing_question_id
         st.subheader(f"✏️ Editando Pregunta ID: {q_id}")
         conn = get_db_conn()
-        row = conn.execute("SELECT * FROM questions WHERE id = ?", (q_id,)).fetchone()
-        conn.close()
+        row = conn.execute(SQL_QUESTION_BY_ID, (q_id,)).fetchone()
         if not row:
             st.error("La pregunta no se encontró.")
             st.session_state.editing_question_id = None
             st.rerun()
 
-        CATEGORIAS_MEDICAS = ["Medicina Interna", "Cirugía General", "Ortopedia", "Urología", "ORL", "Urgencia", "Psiquiatría", "Neurología", "Neurocirugía", "Epidemiología", "Pediatría", "Ginecología", "Oftalmología", "Otra"]
         try:
             cat_index = CATEGORIAS_MEDICAS.index(row['tag_categoria'])
         except (ValueError, TypeError):
@@ -1635,9 +2090,10 @@ def show_manage_questions_page():
                 new_opciones = "|".join([op_a, op_b, op_c, op_d])
                 correcta_val = [op_a, op_b, op_c, op_d][new_correcta_idx]
                 conn = get_db_conn()
-                conn.execute("UPDATE questions SET enunciado=?, opciones=?, correcta=?, retroalimentacion=?, tag_categoria=?, tag_tema=? WHERE id=?", (new_enunciado, new_opciones, correcta_val, new_retro, new_cat, new_tema, q_id))
-                conn.commit()
-                conn.close()
+                with conn:
+                    conn.execute(SQL_UPDATE_QUESTION, (new_enunciado, new_opciones, correcta_val, new_retro, new_cat, new_tema, q_id))
+                load_question.clear(q_id)
+                load_topic_counts.clear()
                 st.success("Pregunta actualizada.")
                 st.session_state.editing_question_id = None
                 st.rerun()
@@ -1650,108 +2106,117 @@ def show_manage_questions_page():
     st.subheader("🔑 Gestionar Preguntas" if is_admin else "📋 Mis Preguntas")
     conn = get_db_conn()
     
-    # Query para Admins (trae todo) o Usuarios (solo las suyas)
-    if is_admin:
-        query = "SELECT id, enunciado, owner_username, status, tag_categoria FROM questions ORDER BY id DESC"
-        params = ()
-    else:
-        query = "SELECT id, enunciado, owner_username, status, tag_categoria FROM questions WHERE owner_username = ? ORDER BY id DESC"
-        params = (st.session_state.current_user,)
-    
+    # 1. Buscador
+    search_q = st.text_input("🔍 Buscar en banco de preguntas:", "").lower().strip()
+
+    # 2. Filtrado y Agrupación en SQL: Admins ven todo, Usuarios solo las suyas;
+    # la búsqueda filtra en la consulta y el ORDER BY deja cada categoría contigua.
+    conditions, params = [], []
+    if not is_admin:
+        conditions.append("owner_username = ?")
+        params.append(st.session_state.current_user)
+    if search_q:
+        conditions.append("instr(unicode_lower(enunciado), ?) > 0")
+        params.append(search_q)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f"""
+        SELECT id, enunciado, owner_username, status,
+               COALESCE(NULLIF(tag_categoria, ''), 'General / Sin Etiqueta') AS categoria
+        FROM questions {where}
+        ORDER BY categoria, id DESC
+    """
     preguntas = conn.execute(query, params).fetchall()
-    conn.close()
 
     if not preguntas:
-        st.info("No hay preguntas registradas.")
-    else:
-        # 1. Buscador
-        search_q = st.text_input("🔍 Buscar en banco de preguntas:", "").lower().strip()
-
-        # 2. Filtrado y Agrupación
-        grouped_questions = {}
-        for p in preguntas:
-            # Filtro de texto
-            if search_q and search_q not in p['enunciado'].lower():
-                continue
-
-            # Agrupación
-            cat = p['tag_categoria'] if p['tag_categoria'] else "General / Sin Etiqueta"
-            if cat not in grouped_questions:
-                grouped_questions[cat] = []
-            grouped_questions[cat].append(p)
-            
-        # 3. Renderizado por Categorías
-        if not grouped_questions:
+        if search_q:
             st.warning(f"🚫 No se encontraron preguntas que coincidan con '{search_q}'.")
         else:
-            for category in sorted(grouped_questions.keys()):
-                count = len(grouped_questions[category])
-                with st.expander(f"📂 {category} ({count})", expanded=False):
-                    for preg in grouped_questions[category]:
-                        # --- INICIO DEL CÓDIGO ORIGINAL DE LA TARJETA ---
-                        pregunta_id = preg['id']
-                        with st.container(border=True):
-                            col_main, col_buttons = st.columns([0.8, 0.2])
-
-                            with col_main:
-                                col_main.write(preg['enunciado'])
+            st.info("No hay preguntas registradas.")
+    else:
+        # 3. Renderizado por Categorías (filas ya ordenadas: groupby sin construir dicts)
+        for category, group in itertools.groupby(preguntas, key=lambda row: row['categoria']):
+            group = list(group)
+            with st.expander(f"📂 {category} ({len(group)})", expanded=False):
+                for preg in group:
+                    # --- INICIO DEL CÓDIGO ORIGINAL DE LA TARJETA ---
+                    pregunta_id = preg['id']
+                    with st.container(border=True):
+                        col_main, col_buttons = st.columns([0.8, 0.2])
+
+                        with col_main:
+                            col_main.write(preg['enunciado'])
                                 
-                                if preg['status'] == 'needs_revision':
-                                    col_main.warning("⚠️ En Revisión")
+                            if preg['status'] == 'needs_revision':
+                                col_main.warning("⚠️ En Revisión")
                                 
-                                if is_admin:
-                                    col_main.caption(f"Autor: {preg['owner_username']}")
+                            if is_admin:
+                                col_main.caption(f"Autor: {preg['owner_username']}")
 
-                            if st.session_state.confirm_delete_id == pregunta_id:
-                                with col_main:
-                                    st.warning("¿Seguro que deseas eliminar esta pregunta?")
+                        if st.session_state.confirm_delete_id == pregunta_id:
+                            with col_main:
+                                st.warning("¿Seguro que deseas eliminar esta pregunta?")
                                 
-                                with col_buttons:
-                                    confirm_col1, confirm_col2 = st.columns(2)
+                            with col_buttons:
+                                confirm_col1, confirm_col2 = st.columns(2)
                                     
-                                    if confirm_col1.button("Sí, eliminar", key=f"confirm_del_{pregunta_id}", type="primary"):
-                                        conn = get_db_conn()
-
-                                        # --- SECURITY CHECK (IDOR) ---
-                                        # Verificar en DB quién es el dueño real antes de borrar
-                                        check_owner = conn.execute("SELECT owner_username FROM questions WHERE id = ?", (pregunta_id,)).fetchone()
-                                        if not check_owner:
-                                            st.error("La pregunta ya no existe.")
-                                            st.stop()
+                                if confirm_col1.button("Sí, eliminar", key=f"confirm_del_{pregunta_id}", type="primary"):
+                                    conn = get_db_conn()
+
+                                    # --- SECURITY CHECK (IDOR) ---
+                                    # Verificar en DB quién es el dueño real antes de borrar
+                                    check_owner = conn.execute(SQL_QUESTION_OWNER, (pregunta_id,)).fetchone()
+                                    if not check_owner:
+                                        st.error("La pregunta ya no existe.")
+                                        st.stop()
                                             
-                                        real_owner = check_owner[0]
-                                        current_user = st.session_state.current_user
-                                        user_role = st.session_state.user_role
+                                    real_owner = check_owner[0]
+                                    current_user = st.session_state.current_user
+                                    user_role = st.session_state.user_role
                                         
-                                        # Solo pasa si eres el dueño O eres admin
-                                        if real_owner != current_user and user_role != 'admin':
-                                            st.error("🚨 ALERTA DE SEGURIDAD: Intento de modificación no autorizado detectado.")
-                                            # (Opcional) Podríamos loguear esto, pero por ahora detenemos la ejecución.
-                                            st.stop()
-                                        # --- FIN SECURITY CHECK ---
-
-                                        conn.execute("DELETE FROM questions WHERE id = ?", (pregunta_id,))
-                                        conn.commit()
-                                        conn.close()
-                                        st.success(f"Pregunta {pregunta_id} eliminada.")
-                                        st.session_state.confirm_delete_id = None
-                                        st.rerun()
+                                    # Solo pasa si eres el dueño O eres admin
+                                    if real_owner != current_user and user_role != 'admin':
+                                        st.error("🚨 ALERTA DE SEGURIDAD: Intento de modificación no autorizado detectado.")
+                                        # (Opcional) Podríamos loguear esto, pero por ahora detenemos la ejecución.
+                                        st.stop()
+                                    # --- FIN SECURITY CHECK ---
+
+                                    with conn:
+                                        conn.execute(SQL_DELETE_QUESTION, (pregunta_id,))
+                                    load_question.clear(pregunta_id)
+                                    load_topic_counts.clear()
+                                    st.success(f"Pregunta {pregunta_id} eliminada.")
+                                    st.session_state.confirm_delete_id = None
+                                    st.rerun()
                                     
-                                    if confirm_col2.button("Cancelar", key=f"cancel_del_{pregunta_id}"):
-                                        st.session_state.confirm_delete_id = None
-                                        st.rerun()
-                            else:
-                                with col_buttons:
-                                    if st.button("✏️ Editar", key=f"edit_{pregunta_id}"):
-                                        st.session_state.editing_question_id = pregunta_id
-                                        st.rerun()
+                                if confirm_col2.button("Cancelar", key=f"cancel_del_{pregunta_id}"):
+                                    st.session_state.confirm_delete_id = None
+                                    st.rerun()
+                        else:
+                            with col_buttons:
+                                if st.button("✏️ Editar", key=f"edit_{pregunta_id}"):
+                                    st.session_state.editing_question_id = pregunta_id
+                                    st.rerun()
                                     
-                                    if st.button("🗑️ Eliminar", key=f"del_{pregunta_id}", type="primary"):
-                                        st.session_state.confirm_delete_id = pregunta_id
-                                        st.rerun()
-                        # --- FIN DEL CÓDIGO ORIGINAL DE LA TARJETA ---
+                                if st.button("🗑️ Eliminar", key=f"del_{pregunta_id}", type="primary"):
+                                    st.session_state.confirm_delete_id = pregunta_id
+                                    st.rerun()
+                    # --- FIN DEL CÓDIGO ORIGINAL DE LA TARJETA ---
 
 # --- INICIO DE SECCIÓN NUEVA: PÁGINA DE DUELOS ---
+# Solo las columnas que usa la interfaz del duelo
+SQL_DUEL_QUESTIONS = "SELECT id, enunciado, opciones, correcta, retroalimentacion FROM questions WHERE id IN ({ids}) ORDER BY id"
+
+def duel_questions_from(cursor):
+    """
+    Preguntas del duelo para session_state: dicts armados con zip sobre los nombres de
+    columna (leídos una vez) y las opciones ya separadas (se parsean una vez, no en cada rerun).
+    """
+    columns = [col[0] for col in cursor.description]
+    questions = [dict(zip(columns, row)) for row in cursor]
+    for question in questions:
+        question['opciones_list'] = question['opciones'].split('|')
+    return questions
+
 def play_duel_interface():
     """
     Maneja la interfaz de un duelo, el historial de respuestas y el resumen final.
@@ -1796,39 +2261,48 @@ def play_duel_interface():
         # --- FIN: Resumen Detallado de Desempeño ---
 
         conn = get_db_conn()
-        cursor = conn.cursor()
         current_user = st.session_state.current_user
         score = st.session_state.duel_user_score
-        
-        duel = cursor.execute("SELECT * FROM duels WHERE id = ?", (duel_id,)).fetchone()
-        
-        # Actualizar puntaje del usuario actual
-        if duel['challenger_username'] == current_user:
-            cursor.execute("UPDATE duels SET challenger_score = ? WHERE id = ?", (score, duel_id))
-            opponent_finished = duel['opponent_score'] is not None
-            opponent_score = duel['opponent_score']
-        else: # es oponente
-            cursor.execute("UPDATE duels SET opponent_score = ? WHERE id = ?", (score, duel_id))
-            opponent_finished = True
-            opponent_score = duel['challenger_score']
-        conn.commit()
 
-        # --- 3. Anuncio del Ganador (Debajo del resumen) ---
+        # Lectura y cierre del duelo en una sola transacción de escritura: BEGIN IMMEDIATE
+        # toma el lock antes del SELECT, así los dos jugadores no se pisan el resultado.
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            duel = conn.execute("SELECT * FROM duels WHERE id = ?", (duel_id,)).fetchone()
+
+            # Puntaje del usuario actual
+            if duel['challenger_username'] == current_user:
+                score_column = 'challenger_score'
+                opponent_finished = duel['opponent_score'] is not None
+                opponent_score = duel['opponent_score']
+            else: # es oponente
+                score_column = 'opponent_score'
+                opponent_finished = True
+                opponent_score = duel['challenger_score']
+
+            # --- 3. Anuncio del Ganador (Debajo del resumen) ---
+            if opponent_finished:
+                user_score = score if score is not None else 0
+                opponent_score_val = opponent_score if opponent_score is not None else 0
+                is_tie = (user_score == opponent_score_val)
+
+                # Puntajes por rol; el empate lo gana el retador (>=)
+                challenger, opponent = duel['challenger_username'], duel['opponent_username']
+                if current_user == challenger:
+                    challenger_total, opponent_total = user_score, opponent_score_val
+                else:
+                    challenger_total, opponent_total = opponent_score_val, user_score
+                winner = challenger if challenger_total >= opponent_total else opponent
+
+                # Un solo UPDATE: puntaje + estado final + ganador
+                conn.execute(
+                    f"UPDATE duels SET {score_column} = ?, status = 'finished', winner = ? WHERE id = ?",
+                    (score, winner, duel_id)
+                )
+            else:
+                conn.execute(f"UPDATE duels SET {score_column} = ? WHERE id = ?", (score, duel_id))
+
         if opponent_finished:
-            user_score = score if score is not None else 0
-            opponent_score_val = opponent_score if opponent_score is not None else 0
-            is_tie = (user_score == opponent_score_val)
-
-            if user_score > opponent_score_val:
-                winner = current_user
-            elif opponent_score_val > user_score:
-                winner = duel['challenger_username'] if duel['challenger_username'] != current_user else duel['opponent_username']
-            else:  # Empate
-                winner = duel['challenger_username']  # Empate gana el retador
-            
-            cursor.execute("UPDATE duels SET status = 'finished', winner = ? WHERE id = ?", (winner, duel_id))
-            conn.commit()
-            
             st.markdown("---")
             st.subheader("Resultado Final del Duelo")
 
@@ -1839,7 +2313,6 @@ def play_duel_interface():
             else:
                 st.error(f"💔 Perdiste el duelo contra '{winner}'. Resultado: {user_score} a {opponent_score_val}.")
 
-        conn.close()
         
         if st.button("Volver a Duelos"):
             del st.session_state.duel_state
@@ -1850,7 +2323,7 @@ def play_duel_interface():
 
     # --- 4. LÓGICA DE PREGUNTA EN CURSO ---
     if 'duel_question_start_time' not in st.session_state:
-        st.session_state.duel_question_start_time = datetime.datetime.now()
+        st.session_state.duel_question_start_time = time.monotonic()  # Reloj monotónico: inmune a ajustes de hora (NTP)
 
     pregunta = questions[q_idx]
 
@@ -1859,11 +2332,11 @@ def play_duel_interface():
     st.markdown(f"### {pregunta['enunciado']}")
 
     with st.form(f"duel_q_{pregunta['id']}", clear_on_submit=True):
-        opciones = pregunta['opciones'].split('|')
+        opciones = pregunta['opciones_list']
         user_choice = st.radio("Elige una respuesta:", options=opciones, key=f"duel_radio_{pregunta['id']}")
         
         if st.form_submit_button("Responder"):
-            tiempo_usado = (datetime.datetime.now() - st.session_state.duel_question_start_time).total_seconds()
+            tiempo_usado = time.monotonic() - st.session_state.duel_question_start_time
             
             is_timeout = tiempo_usado > 40
             is_correct = user_choice == pregunta['correcta'] and not is_timeout
@@ -1892,6 +2365,17 @@ def play_duel_interface():
             del st.session_state.duel_question_start_time
             st.rerun()
 
+@st.cache_data(ttl=60, show_spinner=False)
+def load_duel_ranking(admin_user, finished_duels):
+    """Top Duelistas (victorias por usuario, sin el admin). `finished_duels` invalida la entrada al cerrar un duelo."""
+    import pandas as pd
+    with db_conn() as conn:
+        return pd.read_sql_query(
+            "SELECT winner as Usuario, COUNT(id) as Victorias FROM duels WHERE winner IS NOT NULL AND winner != ? GROUP BY winner ORDER BY Victorias DESC",
+            conn,
+            params=(admin_user,)
+        )
+
 def show_duels_page():
     """Página principal de Duelos (PvP Asincrónico), excluyendo al admin de la lógica de juego."""
     st.header("⚔️ Duelos PvP")
@@ -1918,30 +2402,34 @@ def show_duels_page():
     st.subheader("Desafiar a un Oponente")
     if st.button("🤺 Buscar Oponente Aleatorio", use_container_width=True, type="primary"):
         # 2. Modificar consulta para que no seleccione al admin como oponente
-        cursor.execute(
-            "SELECT username FROM users WHERE username != ? AND username != ? AND is_approved = 1 ORDER BY RANDOM() LIMIT 1",
-            (current_user, admin_user)
-        )
-        opponent = cursor.fetchone()
+        # Mismo muestreo que pick_random_question: COUNT + desplazamiento aleatorio
+        opponent_filter = "FROM users WHERE username != ? AND username != ? AND is_approved = 1"
+        total_opponents = cursor.execute(f"SELECT COUNT(*) {opponent_filter}", (current_user, admin_user)).fetchone()[0]
+        opponent = cursor.execute(
+            f"SELECT username {opponent_filter} LIMIT 1 OFFSET ?",
+            (current_user, admin_user, random.randrange(total_opponents))
+        ).fetchone() if total_opponents else None
         
         if not opponent:
             st.warning("No hay otros usuarios disponibles para desafiar.")
         else:
             opponent_username = opponent['username']
-            cursor.execute("SELECT id FROM questions ORDER BY RANDOM() LIMIT 5")
-            questions = cursor.fetchall()
+            # El sorteo solo mueve ids; las filas salen ordenadas por id para que el
+            # retador vea el mismo orden que verá el oponente al aceptar (IN ... por id).
+            questions = duel_questions_from(conn.execute(
+                SQL_DUEL_QUESTIONS.format(ids="SELECT id FROM questions ORDER BY RANDOM() LIMIT 5")
+            ))
             if len(questions) < 5:
                 st.error("No hay suficientes preguntas en la base de datos para un duelo (se necesitan 5).")
             else:
                 question_ids = ",".join([str(q['id']) for q in questions])
                 now = datetime.datetime.now()
                 
-                cursor.execute(
-                    "INSERT INTO duels (challenger_username, opponent_username, question_ids, status, created_at) VALUES (?, ?, ?, 'pending', ?)",
-                    (current_user, opponent_username, question_ids, now)
-                )
-                duel_id = cursor.lastrowid
-                conn.commit()
+                with conn:
+                    duel_id = conn.execute(
+                        "INSERT INTO duels (challenger_username, opponent_username, question_ids, status, created_at) VALUES (?, ?, ?, 'pending', ?)",
+                        (current_user, opponent_username, question_ids, now)
+                    ).lastrowid
                 
                 # Inicialización del estado del duelo
                 st.session_state.duel_state = 'playing'
@@ -1949,7 +2437,7 @@ def show_duels_page():
                 st.session_state.duel_question_index = 0
                 st.session_state.duel_user_score = 0
                 st.session_state.duel_history = [] # INICIALIZAR HISTORIAL
-                st.session_state.duel_questions = [dict(q) for q in conn.execute(f"SELECT * FROM questions WHERE id IN ({question_ids})").fetchall()]
+                st.session_state.duel_questions = questions
                 st.rerun()
 
     st.markdown("---")
@@ -1968,14 +2456,17 @@ def show_duels_page():
             with st.container(border=True):
                 st.write(f"Has sido desafiado por **{duel['challenger_username']}**.")
                 if st.button("🔥 Aceptar Duelo", key=f"accept_{duel['id']}"):
-                    question_ids = duel['question_ids']
+                    question_ids = [int(qid) for qid in duel['question_ids'].split(',')]
                     # Inicialización del estado del duelo
                     st.session_state.duel_state = 'playing'
                     st.session_state.current_duel_id = duel['id']
                     st.session_state.duel_question_index = 0
                     st.session_state.duel_user_score = 0
                     st.session_state.duel_history = [] # INICIALIZAR HISTORIAL
-                    st.session_state.duel_questions = [dict(q) for q in conn.execute(f"SELECT * FROM questions WHERE id IN ({question_ids})").fetchall()]
+                    placeholders = ",".join("?" * len(question_ids))
+                    st.session_state.duel_questions = duel_questions_from(
+                        conn.execute(SQL_DUEL_QUESTIONS.format(ids=placeholders), question_ids)
+                    )
                     st.rerun()
     
     st.markdown("---")
@@ -1983,8 +2474,13 @@ def show_duels_page():
     # Sección de Estadísticas y Ranking
     st.subheader("Estadísticas y Ranking de Duelos")
     
-    wins = cursor.execute("SELECT COUNT(*) FROM duels WHERE winner = ?", (current_user,)).fetchone()[0]
-    losses = cursor.execute("SELECT COUNT(*) FROM duels WHERE winner != ? AND (challenger_username = ? OR opponent_username = ?)", (current_user, current_user, current_user)).fetchone()[0]
+    # Victorias y derrotas en una sola pasada (el ganador siempre es uno de los dos jugadores;
+    # los duelos sin ganador dan NULL y SUM los ignora)
+    wins, losses = cursor.execute("""
+        SELECT COALESCE(SUM(winner = :user), 0), COALESCE(SUM(winner != :user), 0)
+        FROM duels
+        WHERE challenger_username = :user OR opponent_username = :user
+    """, {'user': current_user}).fetchone()
     
     col1, col2 = st.columns(2)
     col1.metric("Duelos Ganados", wins)
@@ -1992,50 +2488,55 @@ def show_duels_page():
 
     # 3. Modificar consulta del ranking para excluir al admin de los resultados
     st.markdown("##### Top Duelistas")
-    ranking_df = pd.read_sql_query(
-        "SELECT winner as Usuario, COUNT(id) as Victorias FROM duels WHERE winner IS NOT NULL AND winner != ? GROUP BY winner ORDER BY Victorias DESC",
-        conn,
-        params=(admin_user,)
-    )
+    # Clave del caché: cantidad de duelos con ganador (sube con cada duelo terminado)
+    finished_duels = conn.execute("SELECT COUNT(winner) FROM duels").fetchone()[0]
+    ranking_df = load_duel_ranking(admin_user, finished_duels)
     if not ranking_df.empty:
         ranking_df.index += 1
         st.dataframe(ranking_df, use_container_width=True)
     else:
         st.info("Aún no hay resultados de duelos para mostrar un ranking.")
 
-    conn.close()
 # --- FIN DE SECCIÓN NUEVA ---
 
-def get_user_analytics(username):
-    conn = get_db_conn()
-    # Traemos los últimos 500 eventos de respuesta
+@st.cache_data(ttl=60, show_spinner=False)
+def get_user_analytics(username, latest_answer_id):
+    """
+    Telemetría de respuestas del usuario como DataFrame. Cacheada: `latest_answer_id`
+    (último 'answer_submitted' del usuario) forma parte de la clave, así que una
+    respuesta nueva invalida la entrada; los reruns del panel la leen de memoria.
+    """
+    import pandas as pd  # Import diferido: solo las páginas con tablas pagan su carga
+    # Historial de respuestas del usuario; SQLite extrae los campos del JSON de metadatos.
+    # Filas corruptas (JSON inválido o que no es un objeto) se descartan en la propia consulta.
     query = """
-        SELECT timestamp, metadata 
+        SELECT timestamp,
+               json_extract(metadata, '$.time_seconds') AS time_seconds,
+               json_extract(metadata, '$.result') AS result,
+               json_extract(metadata, '$.difficulty_rating') AS difficulty_rating,
+               json_extract(metadata, '$.topic') AS topic
         FROM activity_log 
-        WHERE username = ? AND action_type = 'answer_submitted' 
+        WHERE username = ? AND action_type = 'answer_submitted'
+          AND CASE WHEN json_valid(metadata) THEN json_type(metadata) END = 'object'
         ORDER BY id ASC
     """
-    df = pd.read_sql_query(query, conn, params=(username,))
+    with db_conn() as conn:
+        df = pd.read_sql_query(query, conn, params=(username,))
     
     if df.empty:
         return pd.DataFrame()
 
-    # Procesamiento del JSON en metadatos
-    parsed_data = []
-    for index, row in df.iterrows():
-        try:
-            meta = json.loads(row['metadata'])
-            parsed_data.append({
-                'Fecha': pd.to_datetime(row['timestamp']),
-                'Velocidad (s)': float(meta.get('time_seconds', 0)),
-                'Resultado': meta.get('result', 'unknown'),
-                'Dificultad': meta.get('difficulty_rating', 'N/A'),
-                'Tema': meta.get('topic', 'General')
-            })
-        except:
-            continue # Saltar filas corruptas
-            
-    return pd.DataFrame(parsed_data)
+    # Conversión vectorizada; fecha o velocidad no convertibles = fila corrupta (se salta)
+    fecha = pd.to_datetime(df['timestamp'], format='ISO8601', errors='coerce')
+    velocidad = pd.to_numeric(df['time_seconds'].fillna(0), errors='coerce').astype(float)
+    valid = fecha.notna() & velocidad.notna()
+    return pd.DataFrame({
+        'Fecha': fecha[valid],
+        'Velocidad (s)': velocidad[valid],
+        'Resultado': df['result'][valid].fillna('unknown'),
+        'Dificultad': df['difficulty_rating'][valid].fillna('N/A'),
+        'Tema': df['topic'][valid].fillna('General')
+    }).reset_index(drop=True)
 
 class PredictionEngine:
     def __init__(self, current_user_stats):
@@ -2068,8 +2569,315 @@ class PredictionEngine:
             "ghost_specialty": self.ghost.get('admitted_specialty', 'General')
         }
 
+def load_db_backup_bytes():
+    """
+    Snapshot consistente de la BD con la API de backup de SQLite (incluye lo que aún
+    está en el -wal, a diferencia de leer el archivo crudo). Sin caché: solo se arma
+    al hacer clic en la descarga y no queda una copia de la BD en memoria.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        src = sqlite3.connect(DB_PATH)
+        dst = sqlite3.connect(tmp_path)
+        try:
+            src.backup(dst, pages=1024)
+        finally:
+            dst.close()
+            src.close()
+        with open(tmp_path, "rb") as fp:
+            return fp.read()
+    finally:
+        os.remove(tmp_path)
+
+def set_batch_execution_pending(usernames):
+    """Callback: guarda (o limpia con None) la selección pendiente de ejecución."""
+    st.session_state.batch_execution_pending = usernames
+
+@st.fragment
+def show_judgment_zone_section():
+    """Zona de Juicio. Fragmento: sus botones solo re-ejecutan esta sección."""
+    import pandas as pd  # Import diferido: solo las páginas con tablas pagan su carga
+    conn = get_db_conn()
+
+    # --- 2. SECCIÓN: ZONA DE JUICIO ---
+    st.markdown("---")
+    # Clave barata del caché: quiénes están condenados (con su config) y el último evento registrado
+    pending_key = tuple(tuple(row) for row in conn.execute(
+        "SELECT username, max_inactivity_days, intensive_start_date FROM users WHERE status = 'pending_delete' ORDER BY username"
+    ).fetchall())
+    latest_activity_id = conn.execute("SELECT MAX(id) FROM activity_log").fetchone()[0]
+    pending_deletion_users = get_pending_deletion_scores(pending_key, latest_activity_id) if pending_key else []
+
+    with st.expander("💀 Zona de Juicio (Pendientes de Eliminación)", expanded=False):
+        if not pending_deletion_users:
+            st.info("No hay usuarios pendientes de eliminación.")
+            return
+
+        search_juicio = st.text_input("🔍 Buscar condenado:", "", key="search_juicio").lower()
+        
+        # Filtrar lista
+        filtered_pending = [u for u in pending_deletion_users if search_juicio in u['username'].lower()]
+        if not filtered_pending:
+            st.warning("No se encontraron coincidencias.")
+            return
+
+        # Una sola tabla con selección múltiple (en vez de un contenedor con botones por usuario)
+        reasons = {u['username']: f"Puntaje de productividad bajo ({u['score']}/30)" for u in filtered_pending}
+        juicio_df = pd.DataFrame({
+            "Usuario": [u['username'] for u in filtered_pending],
+            "Puntaje": [u['score'] for u in filtered_pending],
+            "Motivo": [reasons[u['username']] for u in filtered_pending],
+        })
+        selection = st.dataframe(
+            juicio_df, key="juicio_table", on_select="rerun", selection_mode="multi-row",
+            hide_index=True, use_container_width=True
+        )
+        selected = [juicio_df.iloc[i]["Usuario"] for i in selection.selection.rows if i < len(juicio_df)]
+        st.caption(f"Seleccionados: {len(selected)}")
+
+        if selected and st.session_state.get('batch_execution_pending') == selected:
+            st.warning(f"¿Seguro que deseas ELIMINAR PERMANENTEMENTE a {', '.join(selected)}?")
+            exec_col, cancel_exec_col = st.columns(2)
+            if exec_col.button("✅ Sí, ejecutar", key="batch_exec_confirm", type="primary"):
+                now = datetime.datetime.now()
+                try:
+                    # Un DELETE por tabla + un executemany al cementerio, todo en una transacción
+                    with conn:
+                        executed = delete_users_from_db(selected, conn)
+                        conn.executemany(SQL_INSERT_DELETED, [(u, now, reasons[u]) for u in executed])
+                    clear_purged_user_caches()
+                    reclaim_free_pages(conn)
+                    st.session_state.batch_execution_pending = None
+                    st.success(f"Ejecutados: {', '.join(executed)}.")
+                except sqlite3.Error as e:
+                    st.error(f"Error de base de datos al ejecutar: {e}")
+                st.rerun()
+            cancel_exec_col.button("❌ No, cancelar ejecución", key="batch_exec_cancel",
+                                   on_click=set_batch_execution_pending, args=(None,))
+        else:
+            pardon_col, execute_col = st.columns(2)
+            if pardon_col.button("Indultar (Perdonar) seleccionados", key="batch_pardon_btn", disabled=not selected):
+                now = datetime.datetime.now()
+                with conn:
+                    conn.executemany(SQL_PARDON, [(u,) for u in selected])
+                    conn.executemany(SQL_LOG_PARDONED, [(u, now) for u in selected])
+                st.success(f"Indultados y reactivados: {', '.join(selected)}.")
+                st.rerun()
+            execute_col.button("Ejecutar (Eliminar) seleccionados", key="batch_exec_btn", type="primary",
+                               disabled=not selected, on_click=set_batch_execution_pending, args=(selected,))
+
+@st.cache_data(max_entries=1, show_spinner=False)
+def load_deleted_log(latest_deleted_id):
+    """
+    Los 500 eliminados más recientes y sus nombres ya en minúsculas para el buscador.
+    Cacheado por el último id del cementerio: solo se relee cuando alguien es eliminado.
+    """
+    import pandas as pd  # Import diferido: solo las páginas con tablas pagan su carga
+    with db_conn() as conn:
+        # Índice idx_deletion_date y tipos Arrow en vez de objetos Python
+        deleted_log_df = pd.read_sql_query(
+            "SELECT username, deletion_date, reason FROM deleted_users_log ORDER BY deletion_date DESC LIMIT 500",
+            conn, dtype_backend="pyarrow"
+        )
+    return deleted_log_df, deleted_log_df['username'].astype(str).str.lower()
+
+@st.fragment
+def show_deleted_log_section():
+    """Historial de eliminados (cementerio)."""
+    conn = get_db_conn()
+
+    # --- 3. SECCIÓN: HISTORIAL DE ELIMINADOS ---
+    st.markdown("---")
+    latest_deleted_id = conn.execute("SELECT MAX(id) FROM deleted_users_log").fetchone()[0]
+    deleted_log_df, usernames_lower = load_deleted_log(latest_deleted_id)
+
+    with st.expander("🪵 Historial de Eliminados (Cementerio)", expanded=False):
+        # Asumiendo que deleted_log_df ya está creado antes de esto
+        if deleted_log_df.empty:
+            st.info("El cementerio está vacío.")
+        else:
+            search_hist = st.text_input("🔍 Buscar en historial:", "", key="search_hist")
+            
+            if search_hist:
+                # Filtro simple: subcadena literal (sin regex) sobre los nombres ya en minúsculas
+                mask = usernames_lower.str.contains(search_hist.lower(), regex=False, na=False)
+                st.dataframe(deleted_log_df[mask], use_container_width=True)
+            else:
+                st.dataframe(deleted_log_df, use_container_width=True)
+
+@st.fragment
+def show_backup_section():
+    """Descarga del backup de la base de datos."""
+    # --- INICIO DE LA NUEVA SECCIÓN DE BACKUP ---
+    st.markdown("---")
+    st.subheader("📦 Copia de Seguridad (Backup)")
+
+    try:
+        # data como función: Streamlit la llama recién al hacer clic (no en cada rerun del panel)
+        st.download_button(
+            label="Descargar Base de Datos (SQLite)",
+            data=load_db_backup_bytes,
+            file_name=f"backup_prisma_srs_{datetime.date.today().strftime('%Y-%m-%d')}.db",
+            mime="application/x-sqlite3"
+        )
+        st.info("Este archivo contiene todos los datos de usuarios y preguntas. Guárdalo en un lugar seguro.")
+    except FileNotFoundError:
+        st.error(f"Error: No se encontró el archivo de la base de datos en la ruta: {DB_PATH}")
+    except Exception as e:
+        st.error(f"Ocurrió un error inesperado al leer el archivo de la base de datos: {e}")
+
+    # Mantenimiento ocasional: reescribe el archivo completo y lo deja al mínimo
+    if st.button("🧹 Compactar Base de Datos (VACUUM)", key="vacuum_btn"):
+        try:
+            with st.spinner("Compactando..."):
+                get_db_conn().execute("VACUUM")
+            st.success("Base de datos compactada.")
+        except sqlite3.Error as e:
+            st.error(f"No se pudo compactar la base de datos: {e}")
+    # --- FIN DE LA NUEVA SECCIÓN DE BACKUP ---
+
+EXPORT_XLSX_MAX_LOG_ROWS = 50_000  # Por encima, la telemetría se exporta en CSV
+
+@st.fragment
+def show_data_export_section():
+    """Exportación del dataset a Excel."""
+    # --- INICIO DE EXPORTACIÓN DE DATOS PARA ANÁLISIS ---
+    st.markdown("---")
+    st.subheader("📊 Exportar Data para Análisis")
+
+    def safe_json_load(x):
+        """Intenta cargar un JSON, si falla (o no es un objeto) devuelve un diccionario vacío."""
+        try:
+            # Asegurarse que el dato no es nulo y es un string
+            if x and isinstance(x, str):
+                meta = json.loads(x)
+                return meta if isinstance(meta, dict) else {}
+        except (json.JSONDecodeError, TypeError):
+            pass # Ignora el error y retorna el dict vacío
+        return {}
+
+    # Renombrar columnas de metadatos para mayor claridad en el Excel
+    rename_map = {
+        'time_seconds': 'Velocidad (s)',
+        'topic': 'Tema',
+        'result': 'Resultado',
+        'difficulty_rating': 'Dificultad'
+    }
+
+    def write_telemetry(ro_conn, append):
+        """
+        Escribe la telemetría (encabezado + una fila por evento) con `append`, fila a fila
+        desde el cursor: memoria constante sin importar el tamaño del log.
+        Todo corre en una transacción de lectura: las columnas descubiertas y las filas
+        salen de la misma instantánea (en WAL no bloquea al escritor).
+        """
+        ro_conn.execute("BEGIN DEFERRED")
+        try:
+            _write_telemetry_rows(ro_conn, append)
+        finally:
+            # Solo lectura: cerrar con rollback es seguro aun si el cursor quedó a medias
+            ro_conn.rollback()
+
+    def _write_telemetry_rows(ro_conn, append):
+        # Columnas de metadatos (claves de nivel superior en orden de aparición), calculadas en SQLite
+        log_columns = [col[1] for col in ro_conn.execute("PRAGMA table_info(activity_log)") if col[1] != 'metadata']
+        meta_keys = [row[0] for row in ro_conn.execute("""
+            SELECT key FROM (
+                SELECT j.key, a.id AS row_id, j.id AS pos,
+                       ROW_NUMBER() OVER (PARTITION BY j.key ORDER BY a.id, j.id) AS rn
+                FROM activity_log a, json_each(CASE WHEN json_valid(a.metadata) AND json_type(a.metadata) = 'object' THEN a.metadata ELSE '{}' END) j
+            )
+            WHERE rn = 1
+            ORDER BY row_id, pos
+        """)]
+        append(log_columns + [rename_map.get(key, key) for key in meta_keys])
+        for row in ro_conn.execute(f"SELECT {', '.join(log_columns)}, metadata FROM activity_log"):
+            meta = safe_json_load(row['metadata'])
+            values = [meta.get(key) for key in meta_keys]
+            # Valores anidados (listas/objetos) se escriben como texto JSON
+            values = [json.dumps(v) if isinstance(v, (dict, list)) else v for v in values]
+            append([row[col] for col in log_columns] + values)
+
+    @st.cache_data(ttl=600, max_entries=1, show_spinner=False)
+    def generate_excel_export(data_version, include_telemetry=True):
+        """
+        Genera un archivo Excel con los datos del sistema y lo devuelve como bytes.
+        Cacheado por `data_version` (último id de activity_log y cantidad de usuarios):
+        entre escrituras todos los admins reciben el mismo archivo; el ttl cubre las
+        ediciones de usuarios que no dejan rastro en el log.
+        """
+        import openpyxl
+
+        # Libro en modo write_only: las filas se escriben en streaming, sin el grafo de celdas en memoria
+        workbook = openpyxl.Workbook(write_only=True)
+        with db_conn() as ro_conn:
+            # --- Hoja 1: Usuarios ---
+            # password_hash se excluye en el propio SELECT
+            user_columns = [col[1] for col in ro_conn.execute("PRAGMA table_info(users)") if col[1] != 'password_hash']
+            ws_users = workbook.create_sheet('Usuarios')
+            ws_users.append(user_columns)
+            for row in ro_conn.execute(f"SELECT {', '.join(user_columns)} FROM users"):
+                ws_users.append(tuple(row))
+
+            # --- Hoja 2: Telemetría (solo en logs chicos; los grandes van a CSV) ---
+            if include_telemetry:
+                write_telemetry(ro_conn, workbook.create_sheet('Telemetría').append)
+
+        output = io.BytesIO()
+        workbook.save(output)
+        output.seek(0)
+        return output.getvalue()
+
+    def open_telemetry_csv():
+        """
+        Telemetría en CSV (UTF-8 con BOM para que Excel respete las tildes), escrita fila a fila
+        en un archivo temporal anónimo que se devuelve abierto. Se genera recién al hacer clic;
+        no queda copia en caché ni en la sesión (el archivo se borra al cerrarse).
+        """
+        output = tempfile.TemporaryFile()
+        text = io.TextIOWrapper(output, encoding='utf-8-sig', newline='')
+        with db_conn() as ro_conn:
+            write_telemetry(ro_conn, csv.writer(text).writerow)
+        text.detach()  # detach() vacía el buffer y deja el archivo binario abierto
+        output.seek(0)
+        return output
+
+    try:
+        # Solo se genera cuando el admin lo pide; el resultado queda en la sesión
+        if st.button("Generar Dataset", key="generate_export_btn"):
+            with st.spinner("Generando dataset..."):
+                data_version = tuple(get_db_conn().execute(
+                    "SELECT (SELECT MAX(id) FROM activity_log), (SELECT COUNT(*) FROM users)"
+                ).fetchone())
+                # MAX(id) acota el tamaño del log sin recorrerlo. Por encima del umbral la
+                # telemetría sale en CSV: XLSX (zip + XML) cuesta mucho más por fila
+                large_log = (data_version[0] or 0) > EXPORT_XLSX_MAX_LOG_ROWS
+                st.session_state.export_bytes = generate_excel_export(data_version, include_telemetry=not large_log)
+                st.session_state.export_csv_deferred = large_log
+
+        if 'export_bytes' in st.session_state:
+            st.download_button(
+                label="Descargar Dataset Completo (.xlsx)",
+                data=st.session_state.export_bytes,
+                file_name=f"dataset_k_community_{datetime.date.today().strftime('%Y-%m-%d')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+        if st.session_state.get('export_csv_deferred'):
+            st.caption("La telemetría es muy grande para Excel: el .xlsx trae solo Usuarios y la telemetría va en CSV.")
+            st.download_button(
+                label="Descargar Telemetría (.csv)",
+                data=open_telemetry_csv,
+                file_name=f"telemetria_k_community_{datetime.date.today().strftime('%Y-%m-%d')}.csv",
+                mime="text/csv"
+            )
+    except Exception as e:
+        st.error(f"Ocurrió un error al generar el dataset para descarga: {e}")
+    # --- FIN DE EXPORTACIÓN DE DATOS PARA ANÁLISIS ---
+
 def show_admin_panel():
     """Página de gestión de usuarios, moderación, backups y logs."""
+    import pandas as pd  # Import diferido: solo las páginas con tablas pagan su carga
     if st.session_state.user_role != 'admin':
         st.error("Acceso denegado."); return
     
@@ -2078,8 +2886,6 @@ def show_admin_panel():
     # Initialize session state for confirmations
     if 'admin_pending_action' not in st.session_state:
         st.session_state.admin_pending_action = None
-    if 'execution_pending_user' not in st.session_state:
-        st.session_state.execution_pending_user = None
 
     conn = get_db_conn()
 
@@ -2087,15 +2893,17 @@ def show_admin_panel():
     
     with st.expander("📊 Abrir Panel de Telemetría", expanded=False):
         # 1. Obtener lista de usuarios para el selector
-        users_list_df = pd.read_sql_query("SELECT username FROM users", conn)
-        all_users = users_list_df['username'].tolist()
+        all_users = load_user_list()
         
         if all_users:
             # Selector de Usuario (Por defecto el 'cun' o el primero)
             tgt_user = st.selectbox("Seleccionar Usuario a Espiar:", all_users, index=0)
             
             # 2. Obtener Datos
-            df_analytics = get_user_analytics(tgt_user)
+            latest_answer_id = conn.execute(
+                "SELECT MAX(id) FROM activity_log WHERE username = ? AND action_type = 'answer_submitted'", (tgt_user,)
+            ).fetchone()[0]
+            df_analytics = get_user_analytics(tgt_user, latest_answer_id)
             
             if not df_analytics.empty:
                 # 3. KPIs
@@ -2146,8 +2954,12 @@ def show_admin_panel():
                     st.warning("⚠️ No se ha configurado un Usuario Fantasma (Referencia) en la BD.")
 
                 # 4. Gráficas
-                st.caption("📈 Evolución de Velocidad (Segundos por Pregunta)")
-                st.line_chart(df_analytics.set_index('Fecha')['Velocidad (s)'])
+                st.caption("📈 Evolución de Velocidad (Segundos por Pregunta, promedio diario)")
+                # Un punto por día en vez de uno por respuesta: menos datos viajan al navegador
+                velocidad_diaria = pd.Series(
+                    df_analytics['Velocidad (s)'].to_numpy(), index=df_analytics['Fecha']
+                ).resample('1D').mean().dropna()
+                st.line_chart(velocidad_diaria)
                 
                 st.caption("🎯 Distribución de Resultados")
                 res_counts = df_analytics['Resultado'].value_counts()
@@ -2163,24 +2975,24 @@ def show_admin_panel():
                 ghost_profile = get_ghost_profile()
                 
                 if ghost_profile:
-                    # Traemos los logs del fantasma
-                    df_ghost = get_user_analytics(ghost_profile['username'])
-                    
-                    if not df_ghost.empty and not df_analytics.empty:
-                        # 2. Agrupar por 'Tema' y calcular % de acierto
-                        # Usuario Actual
-                        user_topic_acc = df_analytics.groupby('Tema').apply(
-                            lambda x: (x['Resultado'] == 'correct').mean() * 100
-                        ).rename("Usuario")
-                        
-                        # Fantasma
-                        ghost_topic_acc = df_ghost.groupby('Tema').apply(
-                            lambda x: (x['Resultado'] == 'correct').mean() * 100
-                        ).rename("Fantasma")
-                        
-                        # 3. Unir (Merge) para comparar
-                        # fillna(0) es importante por si el usuario no ha visto un tema que el fantasma sí
-                        comparison_df = pd.concat([user_topic_acc, ghost_topic_acc], axis=1).fillna(0)
+                    # % de acierto por tema de ambos usuarios, leído de user_topic_stats (pre-agregado por triggers)
+                    ghost_user = ghost_profile['username']
+                    topic_acc = pd.read_sql_query("""
+                        SELECT username, topic AS Tema, correct * 100.0 / total AS acc
+                        FROM user_topic_stats
+                        WHERE username IN (?, ?) AND total > 0
+                    """, conn, params=(tgt_user, ghost_user))
+                    by_user = {user: rows.set_index('Tema')['acc'] for user, rows in topic_acc.groupby('username')}
+
+                    if tgt_user in by_user and ghost_user in by_user:
+                        # 2-3. Unir para comparar sobre la unión (ordenada) de temas
+                        # fill_value=0 es importante por si el usuario no ha visto un tema que el fantasma sí
+                        user_acc, ghost_acc = by_user[tgt_user], by_user[ghost_user]
+                        topics = user_acc.index.union(ghost_acc.index)
+                        comparison_df = pd.DataFrame({
+                            "Usuario": user_acc.reindex(topics, fill_value=0),
+                            "Fantasma": ghost_acc.reindex(topics, fill_value=0),
+                        })
                         
                         # 4. Visualización
                         st.bar_chart(comparison_df)
@@ -2216,12 +3028,11 @@ def show_admin_panel():
     
     # --- 1. SECCIÓN: GESTIONAR USUARIOS ACTIVOS ---
     
-    usuarios_activos = conn.execute(
-        "SELECT username, role, is_approved, is_intensive, max_inactivity_days, status, is_reference_model, admitted_status, admitted_specialty, final_accuracy_snapshot, avg_daily_questions, avg_seconds_per_question, total_questions_snapshot FROM users WHERE username != ? AND status = 'active'", 
-        (admin_user,)
-    ).fetchall()
+    total_activos = conn.execute(
+        "SELECT COUNT(*) FROM users WHERE username != ? AND status = 'active'", (admin_user,)
+    ).fetchone()[0]
 
-    if not usuarios_activos:
+    if not total_activos:
         st.info("No hay usuarios activos para gestionar.")
     else:
         st.markdown("### 👥 Gestión de Accesos")
@@ -2230,16 +3041,19 @@ def show_admin_panel():
             # 1. Buscador
             search_query = st.text_input("🔍 Buscar por nombre de usuario:", "").lower().strip()
             
-            # 2. Filtrado seguro
+            # 2. Filtrado en SQL (mismo unicode_lower que "Gestionar Preguntas")
             # Si hay texto, filtramos. Si no, mostramos todos.
-            if search_query:
-                filtered_users = [u for u in usuarios_activos if search_query in u['username'].lower()]
-            else:
-                filtered_users = usuarios_activos
+            filtered_users = conn.execute(
+                """SELECT username, role, is_approved, is_intensive, max_inactivity_days, status, is_reference_model, admitted_status, admitted_specialty, final_accuracy_snapshot, avg_daily_questions, avg_seconds_per_question, total_questions_snapshot
+                   FROM users
+                   WHERE username != :admin AND status = 'active'
+                     AND (:q = '' OR instr(unicode_lower(username), :q) > 0)""",
+                {'admin': admin_user, 'q': search_query}
+            ).fetchall()
                 
             # 3. Contador de resultados
             if search_query:
-                st.caption(f"Encontrados: {len(filtered_users)} de {len(usuarios_activos)}")
+                st.caption(f"Encontrados: {len(filtered_users)} de {total_activos}")
             
             # 4. Bucle sobre la lista FILTRADA
             if filtered_users:
@@ -2268,16 +3082,21 @@ def show_admin_panel():
                             confirm_col, cancel_col = st.columns(2)
                             if confirm_col.button("✅ Sí, confirmar", key=f"confirm_{username}", type="primary"):
                                 action = pending_action['action']
-                                if action == 'aprobar':
-                                    conn.execute("UPDATE users SET is_approved = 1 WHERE username = ?", (username,))
-                                    conn.commit()
-                                    st.success(f"Usuario {username} aprobado.")
-                                elif action == 'revocar':
-                                    conn.execute("UPDATE users SET is_approved = 0 WHERE username = ?", (username,))
-                                    conn.commit()
-                                    st.success(f"Aprobación de {username} revocada.")
-                                elif action == 'eliminar':
-                                    delete_user_from_db(username)
+                                try:
+                                    with conn:
+                                        if action == 'aprobar':
+                                            conn.execute(SQL_SET_APPROVED, (1, username))
+                                            st.success(f"Usuario {username} aprobado.")
+                                        elif action == 'revocar':
+                                            conn.execute(SQL_SET_APPROVED, (0, username))
+                                            st.success(f"Aprobación de {username} revocada.")
+                                        elif action == 'eliminar':
+                                            delete_user_from_db(username, conn)
+                                    if action == 'eliminar':
+                                        clear_purged_user_caches()
+                                        reclaim_free_pages(conn)
+                                except sqlite3.Error as e:
+                                    st.error(f"Error de base de datos: {e}")
                                 
                                 st.session_state.admin_pending_action = None
                                 st.rerun()
@@ -2308,20 +3127,22 @@ def show_admin_panel():
                                 
                                 # --- INICIO DE LA CORRECCIÓN LÓGICA ---
                                 # Si se está activando el modo intensivo, guardar la fecha de inicio.
-                                # Si se desactiva, se limpia la fecha.
-                                if new_is_intensive == 1 and not user_row['is_intensive']:
-                                    # Se está activando AHORA
-                                    start_date = datetime.date.today()
-                                    conn.execute("UPDATE users SET is_intensive = ?, max_inactivity_days = ?, intensive_start_date = ? WHERE username = ?", (new_is_intensive, inactivity_days, start_date, username))
-                                elif new_is_intensive == 0 and user_row['is_intensive']:
-                                    # Se está desactivando AHORA
-                                    conn.execute("UPDATE users SET is_intensive = ?, intensive_start_date = NULL WHERE username = ?", (new_is_intensive, username))
-                                else:
-                                    # Solo se actualizan los días, sin cambiar estado o fecha
-                                    conn.execute("UPDATE users SET max_inactivity_days = ? WHERE username = ?", (inactivity_days, username))
+                                # Si se desactiva, se limpia la fecha. Si no cambia, se conserva.
+                                # Una sola sentencia: el CASE compara contra el estado guardado en la fila.
+                                with conn:
+                                    conn.execute("""
+                                        UPDATE users SET
+                                            is_intensive = :on,
+                                            max_inactivity_days = :days,
+                                            intensive_start_date = CASE
+                                                WHEN :on = 0 THEN NULL
+                                                WHEN is_intensive = 0 THEN :today
+                                                ELSE intensive_start_date END
+                                        WHERE username = :user
+                                    """, {'on': new_is_intensive, 'days': inactivity_days,
+                                          'today': datetime.date.today(), 'user': username})
                                 # --- FIN DE LA CORRECCIÓN LÓGICA ---
                                 
-                                conn.commit()
                                 st.success(f"Configuración de Modo Intensivo guardada para {username}.")
                                 st.rerun()
 
@@ -2354,198 +3175,29 @@ def show_admin_panel():
                             new_total = c7.number_input("Total Histórico", value=int(user_row['total_questions_snapshot'] or 0), key=f"tot_{user_row['username']}")
 
                             if st.form_submit_button('Guardar Rol Fantasma'):
-                                conn.execute(
-                                    """UPDATE users SET 
-                                        is_reference_model=?, admitted_status=?, admitted_specialty=?, 
-                                        final_accuracy_snapshot=?, avg_daily_questions=?, avg_seconds_per_question=?, 
-                                        total_questions_snapshot=? 
-                                       WHERE username=?""",
-                                    (1 if new_is_ref else 0, new_status, new_specialty, new_acc, new_daily, new_speed, new_total, username)
-                                )
-                                conn.commit()
+                                with conn:
+                                    conn.execute(
+                                        """UPDATE users SET 
+                                            is_reference_model=?, admitted_status=?, admitted_specialty=?, 
+                                            final_accuracy_snapshot=?, avg_daily_questions=?, avg_seconds_per_question=?, 
+                                            total_questions_snapshot=? 
+                                           WHERE username=?""",
+                                        (1 if new_is_ref else 0, new_status, new_specialty, new_acc, new_daily, new_speed, new_total, username)
+                                    )
+                                get_ghost_profile.clear()
                                 st.success(f"Configuración de Modelo de Referencia guardada para {username}.")
                                 st.rerun()
             else:
                 st.info(f"🚫 No se encontraron usuarios que coincidan con '{search_query}'.")
 
-    # --- 2. SECCIÓN: ZONA DE JUICIO ---
-    st.markdown("---")
-    pending_deletion_users = conn.execute("SELECT * FROM users WHERE status = 'pending_delete'").fetchall()
+    show_judgment_zone_section()
+    show_deleted_log_section()
 
-    with st.expander("💀 Zona de Juicio (Pendientes de Eliminación)", expanded=False):
-        if not pending_deletion_users:
-            st.info("No hay usuarios pendientes de eliminación.")
-        else:
-            search_juicio = st.text_input("🔍 Buscar condenado:", "", key="search_juicio").lower()
-            
-            # Filtrar lista
-            filtered_pending = [u for u in pending_deletion_users if search_juicio in u['username'].lower()]
-            
-            if filtered_pending:
-                for user_row in filtered_pending:
-                    username = user_row['username']
-                    st.markdown("---")
-                    
-                    score, _, _ = calculate_user_score(username, user_row['max_inactivity_days'])
-                    reason = f"Puntaje de productividad bajo ({score}/30)"
-                    
-                    container = st.container(border=True)
-                    container.error(f"**Usuario:** {username}\n\n**Motivo:** {reason}")
-                    
-                    if st.session_state.execution_pending_user == username:
-                        container.warning(f"¿Seguro que deseas ELIMINAR PERMANENTEMENTE a {username}?")
-                        exec_col, cancel_exec_col = container.columns(2)
-                        
-                        if exec_col.button("✅ Sí, ejecutar", key=f"exec_confirm_{username}", type="primary"):
-                            conn.execute("INSERT INTO deleted_users_log (username, deletion_date, reason) VALUES (?, ?, ?)", (username, datetime.datetime.now(), reason))
-                            conn.commit()
-                            delete_user_from_db(username)
-                            st.session_state.execution_pending_user = None
-                            st.success(f"El usuario {username} ha sido ejecutado.")
-                            st.rerun()
-
-                        if cancel_exec_col.button("❌ No, cancelar ejecución", key=f"exec_cancel_{username}"):
-                            st.session_state.execution_pending_user = None
-                            st.rerun()
-                    else:
-                        pardon_col, execute_col = container.columns(2)
-                        if pardon_col.button("Indultar (Perdonar)", key=f"pardon_{username}"):
-                            conn.execute("UPDATE users SET status = 'active' WHERE username = ?", (username,))
-                            conn.execute("INSERT INTO activity_log (username, action_type, timestamp) VALUES (?, 'pardoned', ?)", (username, datetime.datetime.now()))
-                            conn.commit()
-                            st.success(f"{username} ha sido indultado y su cuenta ha sido reactivada.")
-                            st.rerun()
-
-                        if execute_col.button("Ejecutar (Eliminar)", key=f"execute_{username}", type="primary"):
-                            st.session_state.execution_pending_user = username
-                            st.rerun()
-            else:
-                st.warning("No se encontraron coincidencias.")
-
-    # --- 3. SECCIÓN: HISTORIAL DE ELIMINADOS ---
-    st.markdown("---")
-    deleted_log_df = pd.read_sql_query("SELECT username, deletion_date, reason FROM deleted_users_log ORDER BY deletion_date DESC", conn)
-
-    with st.expander("🪵 Historial de Eliminados (Cementerio)", expanded=False):
-        # Asumiendo que deleted_log_df ya está creado antes de esto
-        if deleted_log_df.empty:
-            st.info("El cementerio está vacío.")
-        else:
-            search_hist = st.text_input("🔍 Buscar en historial:", "", key="search_hist")
-            
-            if search_hist:
-                # Filtro simple: busca el texto en la columna username
-                # (Asegúrate de que la columna exista, si no, filtra sobre todo el DF)
-                try:
-                    filtered_df = deleted_log_df[deleted_log_df['username'].astype(str).str.contains(search_hist, case=False, na=False)]
-                    st.dataframe(filtered_df, use_container_width=True)
-                except:
-                    st.dataframe(deleted_log_df, use_container_width=True) # Fallback si falla el filtro
-            else:
-                st.dataframe(deleted_log_df, use_container_width=True)
-
-    conn.close()
-
-    # --- INICIO DE LA NUEVA SECCIÓN DE BACKUP ---
-    st.markdown("---")
-    st.subheader("📦 Copia de Seguridad (Backup)")
-
-    try:
-        with open(DB_PATH, "rb") as fp:
-            st.download_button(
-                label="Descargar Base de Datos (SQLite)",
-                data=fp,
-                file_name=f"backup_prisma_srs_{datetime.date.today().strftime('%Y-%m-%d')}.db",
-                mime="application/x-sqlite3"
-            )
-        st.info("Este archivo contiene todos los datos de usuarios y preguntas. Guárdalo en un lugar seguro.")
-    except FileNotFoundError:
-        st.error(f"Error: No se encontró el archivo de la base de datos en la ruta: {DB_PATH}")
-    except Exception as e:
-        st.error(f"Ocurrió un error inesperado al leer el archivo de la base de datos: {e}")
-    # --- FIN DE LA NUEVA SECCIÓN DE BACKUP ---
-
-    # --- INICIO DE EXPORTACIÓN DE DATOS PARA ANÁLISIS ---
-    st.markdown("---")
-    st.subheader("📊 Exportar Data para Análisis")
-
-    @st.cache_data
-    def generate_excel_export():
-        """
-        Genera un archivo Excel con los datos del sistema y lo devuelve como bytes.
-        Usa cache para no regenerar el archivo en cada rerun.
-        """
-        output = io.BytesIO()
-        conn_export = get_db_conn()
-        try:
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                # --- Hoja 1: Usuarios ---
-                df_users = pd.read_sql_query("SELECT * FROM users", conn_export)
-                if 'password_hash' in df_users.columns:
-                    df_users = df_users.drop(columns=['password_hash'])
-                df_users.to_excel(writer, sheet_name='Usuarios', index=False)
-
-                # --- Hoja 2: Telemetría (NUEVA) ---
-                df_logs = pd.read_sql_query("SELECT * FROM activity_log", conn_export)
-
-                if not df_logs.empty and 'metadata' in df_logs.columns:
-                    def safe_json_load(x):
-                        """Intenta cargar un JSON, si falla devuelve un diccionario vacío."""
-                        try:
-                            # Asegurarse que el dato no es nulo y es un string
-                            if x and isinstance(x, str):
-                                return json.loads(x)
-                        except (json.JSONDecodeError, TypeError):
-                            pass # Ignora el error y retorna el dict vacío
-                        return {}
-
-                    # Normaliza la columna 'metadata' en un nuevo DataFrame
-                    # .apply(safe_json_load) asegura que no falle con JSONs corruptos/vacíos
-                    df_meta = pd.json_normalize(df_logs['metadata'].apply(safe_json_load))
-
-                    # Une los datos normalizados de vuelta al DataFrame original
-                    df_logs = df_logs.join(df_meta)
-
-                    # Renombrar columnas para mayor claridad en el Excel
-                    rename_map = {
-                        'time_seconds': 'Velocidad (s)',
-                        'topic': 'Tema',
-                        'result': 'Resultado',
-                        'difficulty_rating': 'Dificultad'
-                    }
-                    
-                    # Renombrar solo las columnas que existan para evitar errores
-                    existing_renames = {k: v for k, v in rename_map.items() if k in df_logs.columns}
-                    if existing_renames:
-                        df_logs.rename(columns=existing_renames, inplace=True)
-                    
-                    # Eliminar la columna de metadatos original que ya no es necesaria
-                    if 'metadata' in df_logs.columns:
-                        df_logs.drop(columns=['metadata'], inplace=True)
-                
-                # Escribir el DataFrame procesado a la hoja de Excel
-                df_logs.to_excel(writer, sheet_name='Telemetría', index=False)
-
-        finally:
-            conn_export.close()
-        
-        output.seek(0)
-        return output.getvalue()
+    show_backup_section()
 
-    try:
-        # El decorador @st.cache_data se encargará de la eficiencia
-        excel_data = generate_excel_export()
-        
-        st.download_button(
-            label="Descargar Dataset Completo (.xlsx)",
-            data=excel_data,
-            file_name=f"dataset_k_community_{datetime.date.today().strftime('%Y-%m-%d')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-    except Exception as e:
-        st.error(f"Ocurrió un error al generar el dataset para descarga: {e}")
-    # --- FIN DE EXPORTACIÓN DE DATOS PARA ANÁLISIS ---
+    show_data_export_section()
 
+@st.fragment
 def show_change_password_page():
     """Permite al usuario logueado cambiar su propia contraseña."""
     st.subheader("🔐 Cambiar Mi Contraseña")
@@ -2554,17 +3206,26 @@ def show_change_password_page():
         password_confirm = st.text_input("Confirmar Nueva Contraseña", type="password")
         if st.form_submit_button("Actualizar Contraseña"):
             if password_new and password_new == password_confirm:
-                password_new_bytes = password_new.encode('utf-8')[:72]
-                new_hash = pwd_context.hash(password_new_bytes)
+                hash_future = HASH_EXECUTOR.submit(pwd_context.hash, password_new)
+                with st.spinner("Actualizando contraseña..."):
+                    new_hash = hash_future.result()
                 conn = get_db_conn()
-                conn.execute("UPDATE users SET password_hash = ? WHERE username = ?", (new_hash, st.session_state.current_user))
-                conn.commit(); conn.close()
+                # Cambio + registro del evento en una sola transacción (un solo commit)
+                with conn:
+                    conn.execute(SQL_UPDATE_PASSWORD, (new_hash, st.session_state.current_user))
+                    conn.execute(SQL_LOG_INSERT, (st.session_state.current_user, 'password_changed', datetime.datetime.now(), '{}'))
                 st.success("¡Contraseña actualizada con éxito!"); st.balloons()
             else:
                 st.error("Las contraseñas no coinciden o están vacías.")
 
-def run_auto_backup():
-    """Crea una copia de seguridad de la base de datos en la carpeta de backups."""
+MAX_AUTO_BACKUPS = 5  # Backups diarios que se conservan en la carpeta
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def run_auto_backup(day):
+    """
+    Crea una copia de seguridad de la base de datos en la carpeta de backups.
+    Cacheada por día (YYYY-MM-DD): corre una vez por día y por proceso, no por sesión.
+    """
     
     # 1. Definir rutas
     # Ruta de la base de datos original (producción o local)
@@ -2574,30 +3235,72 @@ def run_auto_backup():
     backup_dir = "backups" 
     
     # Nombre del archivo de backup con la fecha actual
-    backup_filename = f"backup_prisma_srs_{datetime.date.today().strftime('%Y-%m-%d')}.db"
+    backup_filename = f"backup_prisma_srs_{day}.db"
     
     # Ruta completa del destino
     dest_db = os.path.join(backup_dir, backup_filename)
     
-    try:
-        # 2. Asegurarse de que el directorio de backups existe
-        os.makedirs(backup_dir, exist_ok=True)
-        
-        # 3. Solo copiar si no existe ya un backup para hoy
-        if not os.path.exists(dest_db):
-            # Copiar el archivo
-            shutil.copy2(source_db, dest_db)
-            print(f"✅ Backup automático creado con éxito en: {dest_db}")
-        else:
-            print(f"ℹ️ El backup de hoy ya existe. No se necesita crear uno nuevo.")
-            
-    except FileNotFoundError:
-        print(f"❌ ERROR en backup: No se encontró la base de datos de origen en '{source_db}'.")
-    except Exception as e:
-        print(f"❌ ERROR inesperado durante el backup automático: {e}")
+    # Sin try/except aquí: cache_resource no memoriza excepciones, así que un fallo
+    # se reintenta en la siguiente ejecución en vez de quedar cacheado todo el día
+    # 2. Asegurarse de que el directorio de backups existe
+    os.makedirs(backup_dir, exist_ok=True)
+
+    # 3. Solo copiar si no existe ya un backup para hoy
+    if not os.path.exists(dest_db):
+        # Copia en caliente con la API de backup de SQLite (consistente con el WAL);
+        # se escribe a un temporal y se renombra para no dejar un backup a medias
+        if not os.path.exists(source_db):
+            raise FileNotFoundError(source_db)
+        tmp_db = dest_db + ".tmp"
+        try:
+            with closing(open_read_only_conn()) as src, closing(sqlite3.connect(tmp_db)) as dst:
+                src.backup(dst, pages=1000, sleep=0.001)
+            os.replace(tmp_db, dest_db)
+        except BaseException:
+            # No dejar el temporal a medias en la carpeta de backups
+            if os.path.exists(tmp_db):
+                os.remove(tmp_db)
+            raise
+        print(f"✅ Backup automático creado con éxito en: {dest_db}")
+
+        # 4. Rotación: conservar solo los más recientes (una lectura del directorio,
+        # y scandir trae el stat de cada entrada sin volver a resolver la ruta)
+        with os.scandir(backup_dir) as entries:
+            backups = sorted(
+                (e for e in entries if e.name.startswith("backup_prisma_srs_") and e.name.endswith(".db")),
+                key=lambda e: e.stat().st_mtime,
+            )
+        for old_backup in backups[:-MAX_AUTO_BACKUPS]:
+            os.remove(old_backup.path)
+    else:
+        print(f"ℹ️ El backup de hoy ya existe. No se necesita crear uno nuevo.")
 
 # --- CONTROLADOR PRINCIPAL (MAIN) ---
 
+def go_to_page(page, reset_evaluation=False):
+    """Callback de navegación del sidebar."""
+    st.session_state.current_page = page
+    if reset_evaluation:
+        reset_evaluation_state()
+
+# Menú del sidebar: (página, etiqueta). Al entrar a las páginas de estudio se reinicia la evaluación.
+NAV_PAGES = [
+    ("evaluacion", "🧠 Iniciar Evaluación"),
+    ("topics", "📚 Biblioteca por Temas"),
+    ("duelos", "⚔️ Duelos"),
+    ("crear", "🖊️ Crear Preguntas"),
+    ("gestionar", "📋 Gestionar Mis Preguntas"),
+    ("estadisticas", "📊 Estadísticas y Ranking"),
+]
+NAV_ADMIN_PAGES = [("admin_users", "🔑 Gestionar Usuarios")]
+NAV_HELP_PAGES = [("rules", "📜 Reglamento / Ayuda"), ("change_password", "🔐 Cambiar Contraseña")]
+NAV_RESET_PAGES = {"evaluacion", "topics"}
+
+def on_nav_change():
+    """Callback del menú: la página cambia ANTES del rerun del clic (una sola ejecución)."""
+    page = st.session_state.nav_page
+    go_to_page(page, page in NAV_RESET_PAGES)
+
 def main():
     """Función principal que actúa como enrutador."""
     if 'logged_in' not in st.session_state:
@@ -2618,32 +3321,20 @@ def main():
 
         st.sidebar.markdown("---")
         
-        # Navegación
-        if st.sidebar.button("🧠 Iniciar Evaluación", use_container_width=True):
-            st.session_state.current_page = "evaluacion"; reset_evaluation_state(); st.rerun()
-        if st.sidebar.button("📚 Biblioteca por Temas", use_container_width=True):
-            st.session_state.current_page = "topics"; reset_evaluation_state(); st.rerun()
-        if st.sidebar.button("⚔️ Duelos", use_container_width=True):
-            st.session_state.current_page = "duelos"; st.rerun()
-        if st.sidebar.button("🖊️ Crear Preguntas", use_container_width=True):
-            st.session_state.current_page = "crear"; st.rerun()
-        if st.sidebar.button("📋 Gestionar Mis Preguntas", use_container_width=True):
-            st.session_state.current_page = "gestionar"; st.rerun()
-        if st.sidebar.button("📊 Estadísticas y Ranking", use_container_width=True):
-            st.session_state.current_page = "estadisticas"; st.rerun()
-            
-        if st.session_state.user_role == 'admin':
-            st.sidebar.markdown("---"); st.sidebar.markdown("Panel de Administrador")
-            if st.sidebar.button("🔑 Gestionar Usuarios", use_container_width=True):
-                st.session_state.current_page = "admin_users"; st.rerun()
+        # Navegación: un solo widget de menú en vez de un botón por página
+        nav_pages = NAV_PAGES + (NAV_ADMIN_PAGES if st.session_state.user_role == 'admin' else []) + NAV_HELP_PAGES
+        nav_labels = dict(nav_pages)
+        # El menú sigue a current_page cuando la cambia el código (login, atajos entre páginas)
+        current_page = st.session_state.get("current_page", "evaluacion")
+        if current_page in nav_labels:
+            st.session_state.nav_page = current_page
+        st.sidebar.radio("Menú", list(nav_labels), key="nav_page", format_func=nav_labels.get,
+                         on_change=on_nav_change, label_visibility="collapsed")
 
         st.sidebar.markdown("---")
-        if st.sidebar.button("📜 Reglamento / Ayuda", use_container_width=True):
-            st.session_state.current_page = "rules"; st.rerun()
-        if st.sidebar.button("🔐 Cambiar Contraseña", use_container_width=True):
-            st.session_state.current_page = "change_password"; st.rerun()
         if st.sidebar.button("Cerrar Sesión", use_container_width=True):
-            for key in list(st.session_state.keys()): del st.session_state[key]
+            close_session_db_conn()
+            st.session_state.clear()
             st.rerun()
 
         page_functions = {
@@ -2664,9 +3355,13 @@ def main():
 # --- EJECUCIÓN ---
 if __name__ == "__main__":
     # --- INICIO: Ejecución de Tareas de Arranque ---
-    if 'backup_done' not in st.session_state:
-        run_auto_backup()
-        st.session_state.backup_done = True
+    try:
+        run_auto_backup(datetime.date.today().strftime('%Y-%m-%d'))
+    except FileNotFoundError:
+        print(f"❌ ERROR en backup: No se encontró la base de datos de origen en '{DB_PATH}'.")
+    except Exception as e:
+        print(f"❌ ERROR inesperado durante el backup automático: {e}")
     # --- FIN: Tareas de Arranque ---
     setup_database()
+    prune_rate_buckets(datetime.date.today().strftime('%Y-%m-%d'))
     main()
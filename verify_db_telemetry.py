@@ -1,17 +1,24 @@
 
 import sqlite3
 import os
+import functools
 
 # --- CONFIGURACIÓN INTELIGENTE ---
-POSIBLES_RUTAS = [
+POSIBLES_RUTAS = (
     "k-comunity/prisma_srs.db",
     "prisma_srs.db",
-]
+)
 
-def encontrar_db():
-    for ruta in POSIBLES_RUTAS:
-        if os.path.exists(ruta) and os.path.getsize(ruta) > 0:
-            return ruta
+@functools.lru_cache(maxsize=1)
+def encontrar_db(rutas=POSIBLES_RUTAS):
+    """Primera ruta existente y no vacía (se busca una sola vez por proceso)."""
+    for ruta in rutas:
+        # Un solo stat por candidata (existe y no está vacía)
+        try:
+            if os.stat(ruta).st_size > 0:
+                return ruta
+        except FileNotFoundError:
+            continue
     return None
 
 db_path = encontrar_db()
@@ -1,15 +1,28 @@
 import sqlite3
 import json
 import os
+import sys
 
 # --- Configuration ---
 # The database file used by the Streamlit app.
 DB_FILE = "prisma_srs.db"
 
-def verify_logs():
+def format_metadata(metadata_str, pretty):
+    """Pretty-prints the JSON only when asked to; otherwise the stored text is printed as is."""
+    if not pretty:
+        return f"  Metadata:  {metadata_str}"
+    try:
+        return f"  Metadata:  \n{json.dumps(json.loads(metadata_str), indent=4)}"
+    except (json.JSONDecodeError, TypeError):
+        return f"  Metadata (raw): {metadata_str}"
+
+def verify_logs(limit=5, pretty=None):
     """
-    Connects to the database and prints the last 5 entries from activity_log.
+    Connects to the database and prints the last `limit` entries from activity_log.
+    Metadata is pretty-printed only on an interactive terminal (unless `pretty` is given).
     """
+    if pretty is None:
+        pretty = sys.stdout.isatty()
     if not os.path.exists(DB_FILE):
         print(f"Error: Database file not found at '{os.path.abspath(DB_FILE)}'")
         print("Please ensure this script is run from the project's root directory (/Users/danielsuarezsucre/cqomunity).")
@@ -19,12 +32,12 @@ def verify_logs():
     try:
         print(f"Connecting to database: {DB_FILE}...")
         conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
 
-        print("\n--- Verifying last 5 events in activity_log ---")
-        query = "SELECT * FROM activity_log ORDER BY id DESC LIMIT 5"
-        cursor.execute(query)
+        print(f"\n--- Verifying last {limit} events in activity_log ---")
+        # id is the rowid: ORDER BY id DESC LIMIT ? walks the table backwards, no sort needed
+        query = "SELECT id, timestamp, username, action_type, metadata FROM activity_log ORDER BY id DESC LIMIT ?"
+        cursor.execute(query, (limit,))
         rows = cursor.fetchall()
 
         if not rows:
@@ -35,20 +48,14 @@ def verify_logs():
         print(f"Found {len(rows)} event(s).")
         print("-" * 50)
 
-        for i, row in enumerate(rows):
-            print(f"EVENT #{i+1} (ID: {row['id']})")
-            print(f"  Timestamp: {row['timestamp']}")
-            print(f"  User:      {row['username']}")
-            print(f"  Action:    {row['action_type']}")
+        for i, (event_id, timestamp, username, action_type, metadata_str) in enumerate(rows):
+            print(f"EVENT #{i+1} (ID: {event_id})")
+            print(f"  Timestamp: {timestamp}")
+            print(f"  User:      {username}")
+            print(f"  Action:    {action_type}")
             
-            metadata_str = row['metadata']
             if metadata_str:
-                try:
-                    metadata_dict = json.loads(metadata_str)
-                    pretty_metadata = json.dumps(metadata_dict, indent=4)
-                    print(f"  Metadata:  \n{pretty_metadata}")
-                except (json.JSONDecodeError, TypeError):
-                    print(f"  Metadata (raw): {metadata_str}")
+                print(format_metadata(metadata_str, pretty))
             else:
                 print("  Metadata:  (empty)")
             